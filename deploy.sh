@@ -8,11 +8,15 @@ files="
   webserver.py
   microdot/__init__.py
   microdot/helpers.py
+  microdot/metrics.py
   microdot/microdot.py 
+  microdot/static.py
   microdot/utemplate.py
   microdot/websocket.py
   static/pure-min.css
+  static/pure-min.css.gz
   static/style.css
+  static/style.css.gz
   templates/delays.tpl
   templates/index.tpl
   utemplate/compiled.py
@@ -28,13 +32,12 @@ if [ $# -ne 1 ]; then
   usage
 fi
 
+# Precompress static files
+gzip -9 -k -f static/pure-min.css static/style.css
+
 # Create new file system (from micropython/ports/rp2/modules/_boot.py)
 mpremote connect $1 exec "import rp2; import vfs; vfs.umount('/'); bdev=rp2.Flash(); vfs.VfsLfs2.mkfs(bdev, progsize=256); fs=vfs.VfsLfs2(bdev, progsize=256); vfs.mount(fs, '/')"
 
-# Add libraries
-mpremote connect $1 mip install tarfile
-mpremote connect $1 mip install tarfile-write
-
 # Create directories
 for d in $dirs; do
   mpremote connect $1 mkdir :$d
@@ -1,9 +1,11 @@
+import array
 import asyncio
 import asyncio.stream
+import json
 import os
-import tarfile
+import struct
 
-from time import ticks_diff, time
+from time import ticks_diff, ticks_ms, ticks_us, time
 
 # End of touch timeout
 READ_TIMEOUT = 5
@@ -17,12 +19,421 @@ MIN_VFS_SPACE = 500000
 # Minimum number of strikes to record
 MIN_STRIKES = 60
 
+# Time (s) between background maintenance checks
+MAINTAIN_INTERVAL = 60
+
+# Start a new session if more than this time (s) since the last touch
+SESSION_GAP = 3600 * 12
+
 S_IFDIR = 0x4000
 
+# Suffix of expired archive directories waiting to be deleted
+EXPIRED_SUFFIX = ".del"
+
+# Touch file record: bell number and ticks since start of touch
+RECORD_FMT = "<Bi"
+RECORD_SIZE = struct.calcsize(RECORD_FMT)
+
+# Strike buffer size, a multiple of both the record size and the 256 byte
+# flash program size
+STRIKE_BUFFER_SIZE = 256 * RECORD_SIZE
+
+# Maximum time (ms) strikes are held in the buffer before writing to flash
+FLUSH_INTERVAL = 10000
+
+# Header line for CSV touch data
+CSV_HEADER = "bell,ticks_ms\n"
+
+# Touch catalog record: touch number, rows, start ticks, byte offset of the
+# touch's line in the CSV form of the catalog, and number of strikes
+CATALOG_FMT = "<HHiII"
+CATALOG_SIZE = struct.calcsize(CATALOG_FMT)
+
+# Header line for CSV touch catalog
+CATALOG_HEADER = "touch,rows,start_ticks_ms\n"
+
+# Number of catalog records read at a time
+CATALOG_CHUNK = 32
+
+# Touch index file: number of bells, followed by the ticks of every
+# INDEX_INTERVAL'th strike record
+INDEX_HEADER_FMT = "<H"
+INDEX_HEADER_SIZE = struct.calcsize(INDEX_HEADER_FMT)
+INDEX_INTERVAL = 128
+
+# Maximum number of strikes in a live strike batch
+LIVE_BATCH_STRIKES = 32
+
+# Live strike batch header: touch number and number of strikes
+LIVE_HEADER_FMT = "<HH"
+LIVE_HEADER_SIZE = struct.calcsize(LIVE_HEADER_FMT)
+
+# Maximum number of unread status events
+MAX_STATUS_EVENTS = 8
+
+# Tar archive block size
+TAR_BLOCK_SIZE = 512
+
+# UART frame types
+FRAME_STRIKE = ord("B")
+FRAME_DELAYS = ord("D")
+
+# UART receive buffer size
+UART_BUFFER_SIZE = 64
+
+# Maximum number of numeric fields in a UART frame
+MAX_FIELDS = 16
+
+# Highest bell number included in touch statistics
+MAX_BELLS = 16
+
+# Ingest histogram bucket upper bounds
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+GAP_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+LAG_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+TIME_BUCKETS_US = (100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000)
+
+
+# Read UART frames into a reusable buffer and parse them in place, one byte at
+# a time, so that no heap allocation is needed per line
+class FrameReader:
+    def __init__(self, stream, size=UART_BUFFER_SIZE):
+        self.stream = stream
+        self.buf = bytearray(size)
+        self.pos = 0
+        self.end = 0
+
+        # Numeric fields of the last frame
+        self.fields = array.array("i", [0] * MAX_FIELDS)
+        self.nfields = 0
+
+        # Number of valid, malformed and unknown type frames seen
+        self.frames = 0
+        self.malformed = 0
+        self.unknown = 0
+
+        # Number of reads that filled the buffer, so more data may have been
+        # waiting in the UART
+        self.full_reads = 0
+
+        # Parser state
+        self.frame = 0
+        self.value = 0
+        self.in_field = False
+        self.error = False
+
+    # Wait for the next valid frame and return its type. The frame's fields
+    # are left in self.fields[:self.nfields]
+    async def read(self):
+        buf = self.buf
+        while True:
+            while self.pos < self.end:
+                c = buf[self.pos]
+                self.pos += 1
+
+                if c == 10:
+                    # End of line
+                    frame = self.end_frame()
+                    if frame:
+                        return frame
+                elif c == 13:
+                    pass
+                elif self.frame == 0:
+                    # Start of frame
+                    self.frame = c
+                    self.nfields = 0
+                elif c == 44:
+                    # Comma, start of next field
+                    self.end_field()
+                    self.in_field = True
+                    self.value = -1
+                elif 48 <= c <= 57 and self.in_field:
+                    self.value = (0 if self.value < 0 else self.value * 10) + c - 48
+                else:
+                    self.error = True
+
+            # Mark the buffer empty first, in case the read is cancelled
+            self.pos = 0
+            self.end = 0
+            self.end = await self.stream.readinto(buf) or 0
+            if self.end == len(buf):
+                self.full_reads += 1
+
+    def end_field(self):
+        if self.in_field:
+            if self.value < 0 or self.nfields == MAX_FIELDS:
+                self.error = True
+            else:
+                self.fields[self.nfields] = self.value
+                self.nfields += 1
+
+    def end_frame(self):
+        self.end_field()
+        frame = self.frame
+
+        if frame == 0:
+            # Ignore blank lines
+            valid = False
+        elif frame != FRAME_STRIKE and frame != FRAME_DELAYS:
+            self.unknown += 1
+            valid = False
+        elif self.error or (frame == FRAME_STRIKE and self.nfields != 2):
+            self.malformed += 1
+            valid = False
+        else:
+            self.frames += 1
+            valid = True
+
+        # Reset for next frame
+        self.frame = 0
+        self.in_field = False
+        self.error = False
+
+        return frame if valid else 0
+
+
+# Running statistics for a touch, updated as each strike arrives using memory
+# proportional to the number of bells. Intervals between strikes of a bell
+# are split by stroke: an interval ending on a handstroke (the bell's 1st,
+# 3rd... strike) includes the handstroke gap. Intervals are summed as offsets
+# from the first interval, so the sums usually stay small integers and
+# updating them doesn't allocate
+class TouchStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.strikes = 0
+        self.first_ticks = 0
+        self.ticks = 0
+
+        # Per bell strike count and ticks of last strike
+        self.count = [0] * (MAX_BELLS + 1)
+        self.last = [0] * (MAX_BELLS + 1)
+
+        # Per bell and stroke (index 2 * bell + stroke, handstroke is 0)
+        # interval count, reference interval, and sums of offsets from the
+        # reference interval and of their squares
+        self.n = [0] * (2 * MAX_BELLS + 2)
+        self.ref = [0] * (2 * MAX_BELLS + 2)
+        self.sum = [0] * (2 * MAX_BELLS + 2)
+        self.sumsq = [0] * (2 * MAX_BELLS + 2)
+
+    def add(self, bell, ticks):
+        if self.strikes == 0:
+            self.first_ticks = ticks
+        self.strikes += 1
+        self.ticks = ticks
+        if bell > MAX_BELLS:
+            return
+
+        count = self.count[bell]
+        if count:
+            i = 2 * bell + (count & 1)
+            interval = ticks - self.last[bell]
+            if self.n[i] == 0:
+                self.ref[i] = interval
+
+            d = interval - self.ref[i]
+            self.n[i] += 1
+            self.sum[i] += d
+            self.sumsq[i] += d * d
+
+        self.count[bell] = count + 1
+        self.last[bell] = ticks
+
+    # Exact interval count, sum and sum of squares for a list of indices
+    def totals(self, indices):
+        n = s = q = 0
+        for i in indices:
+            n += self.n[i]
+            s += self.sum[i] + self.n[i] * self.ref[i]
+            q += (
+                self.sumsq[i]
+                + 2 * self.ref[i] * self.sum[i]
+                + self.n[i] * self.ref[i] * self.ref[i]
+            )
+
+        return n, s, q
+
+    # Statistics as a dictionary, suitable for JSON encoding
+    def result(self):
+        bells = []
+        gaps = []
+        for bell in range(MAX_BELLS + 1):
+            if self.count[bell] == 0:
+                continue
+
+            mean, sd = interval_stats(*self.totals((2 * bell, 2 * bell + 1)))
+            hand = interval_stats(*self.totals((2 * bell,)))[0]
+            back = interval_stats(*self.totals((2 * bell + 1,)))[0]
+            bells.append(
+                {
+                    "bell": bell,
+                    "strikes": self.count[bell],
+                    "interval_ms": mean,
+                    "interval_sd_ms": sd,
+                    "hand_interval_ms": hand,
+                    "back_interval_ms": back,
+                }
+            )
+            if hand is not None and back is not None:
+                gaps.append(hand - back)
+
+        return {
+            "strikes": self.strikes,
+            "rows": self.strikes // len(bells) if bells else 0,
+            "duration_ms": self.ticks - self.first_ticks,
+            "handstroke_gap_ms": round(sum(gaps) / len(gaps), 1) if gaps else None,
+            "bells": bells,
+        }
+
+
+# Mean and standard deviation from count, sum and sum of squares. Integer
+# arithmetic is used until the final division to avoid single precision
+# float rounding
+def interval_stats(n, s, q):
+    if n == 0:
+        return None, None
+
+    mean = round(s / n, 1)
+    if n == 1:
+        return mean, None
+
+    return mean, round(((n * q - s * s) / (n * (n - 1))) ** 0.5, 1)
+
+
+# Histogram with fixed bucket upper bounds, and an overflow bucket
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = array.array("I", [0] * (len(bounds) + 1))
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        i = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            i += 1
+
+        self.counts[i] += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # Histogram as a dictionary, suitable for JSON encoding
+    def result(self):
+        return {
+            "le": list(self.bounds),
+            "counts": list(self.counts),
+            "sum": self.sum,
+            "max": self.max,
+        }
+
+
+# Ingest path counters and histograms, showing whether the logger is keeping
+# up with the sensor bus. Lag is the growth of the difference between local
+# and sensor time since the first strike of the touch
+class IngestStats:
+    def __init__(self):
+        self.timeouts = 0
+
+        self.rate = Histogram(RATE_BUCKETS)
+        self.gap = Histogram(GAP_BUCKETS_MS)
+        self.lag = Histogram(LAG_BUCKETS_MS)
+        self.write_time = Histogram(TIME_BUCKETS_US)
+        self.rotate_time = Histogram(TIME_BUCKETS_US)
+        self.stop_time = Histogram(TIME_BUCKETS_US)
+
+        self.last_ticks = None
+        self.second_ticks = 0
+        self.second_count = 0
+        self.offset = 0
+
+    # Record arrival of a frame
+    def frame(self, now):
+        if self.last_ticks is not None:
+            self.gap.add(ticks_diff(now, self.last_ticks))
+        self.last_ticks = now
+
+        # Frames per second, recorded at the first frame of a later second
+        if ticks_diff(now, self.second_ticks) >= 1000:
+            if self.second_count:
+                self.rate.add(self.second_count)
+            self.second_ticks = now
+            self.second_count = 0
+        self.second_count += 1
+
+    # Record sensor and local time of the first strike of a touch
+    def start_touch(self, now, strike_ticks):
+        self.offset = ticks_diff(now, strike_ticks)
+
+    # Record sensor and local time of a strike
+    def strike(self, now, strike_ticks):
+        self.lag.add(max(ticks_diff(ticks_diff(now, strike_ticks), self.offset), 0))
+
+
+# Number of characters in decimal form of integer
+def ndigits(n):
+    digits = 1
+    if n < 0:
+        n = -n
+        digits += 1
+    while n >= 10:
+        n //= 10
+        digits += 1
+
+    return digits
+
+
+# CSV text for a block of binary strike records
+def records_csv(data):
+    return "".join(
+        "{},{}\n".format(*struct.unpack_from(RECORD_FMT, data, i))
+        for i in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE)
+    )
+
+
+# CSV catalog line for a catalog record
+def catalog_line(entry):
+    return "{},{},{}\n".format(entry[0], entry[1], entry[2])
+
+
+# Size rounded up to whole number of tar blocks
+def tar_padded(size):
+    return (size + TAR_BLOCK_SIZE - 1) // TAR_BLOCK_SIZE * TAR_BLOCK_SIZE
+
+
+# Make (ustar format) tar header block for a regular file
+def tar_header(name, size, mtime):
+    header = bytearray(TAR_BLOCK_SIZE)
+
+    header[0 : len(name)] = name.encode()
+    header[100:108] = b"0000644\0"
+    header[108:116] = b"0000000\0"
+    header[116:124] = b"0000000\0"
+    header[124:136] = "{:011o}\0".format(size).encode()
+    header[136:148] = "{:011o}\0".format(mtime).encode()
+    header[148:156] = b"        "
+    header[156] = ord("0")
+    header[257:265] = b"ustar\x0000"
+
+    header[148:156] = "{:06o}\0 ".format(sum(header)).encode()
+    return header
+
 
 class Logger:
-    def __init__(self, uart, root_dir):
+    def __init__(
+        self,
+        uart,
+        root_dir,
+        flush_size=STRIKE_BUFFER_SIZE,
+        flush_interval=FLUSH_INTERVAL,
+    ):
         self.uart_stream = asyncio.stream.Stream(uart)
+        self.uart_reader = FrameReader(self.uart_stream)
         self.root_dir = root_dir
 
         self.strike_count = 0
@@ -31,56 +442,237 @@ class Logger:
         self.touch_count = 0
         self.log_file = None
 
+        # Strike buffer, written to the touch file when it holds flush_size
+        # bytes or flush_interval ms after the previous write
+        self.strike_buf = bytearray(STRIKE_BUFFER_SIZE)
+        self.strike_mv = memoryview(self.strike_buf)
+        self.strike_len = 0
+        self.touch_size = 0
+        self.flush_size = min(flush_size, STRIKE_BUFFER_SIZE)
+        self.flush_interval = flush_interval
+        self.flush_ticks = 0
+
         self.touch_start_ticks = 0
         self.touch_end_time = time()
 
+        # Local time of the last UART frame, checked by watchdog()
+        self.frame_ticks = 0
+
+        # Ingest instrumentation
+        self.ingest = IngestStats()
+
+        # Statistics and sparse ticks index of the current touch
+        self.touch_stats = TouchStats()
+        self.touch_index = array.array("i")
+
         self.event = asyncio.Event()
 
-        self.catalog_file = self.log_path("log", "_logcat.csv")
+        # Live strike batch, only filled while there are live stream clients.
+        # Strikes are dropped if the batch is full and hasn't been taken
+        self.live_clients = 0
+        self.live_buf = bytearray(LIVE_HEADER_SIZE + LIVE_BATCH_STRIKES * RECORD_SIZE)
+        self.live_count = 0
+        self.live_dropped = 0
+        self.live_event = asyncio.Event()
+
+        # Status change events, read by the web server's status broadcaster
+        self.status_events = []
+        self.status_event = asyncio.Event()
 
-    # Main logging loop
+        self.catalog_file = self.log_path("log", "_logcat.bin")
+
+        # In-memory index of log directories and touch counts, kept up to date
+        # as touches are logged and directories rotated
+        self.build_log_index()
+
+    # Main logging loop. Touches are ended by watchdog() rather than a timeout
+    # on each read, to avoid allocating a timeout task per frame
     async def log(self):
-        while True:
-            try:
-                data = await asyncio.wait_for(self.uart_stream.readline(), READ_TIMEOUT)
+        watchdog = asyncio.create_task(self.watchdog())
+        try:
+            while True:
+                frame = await self.uart_reader.read()
+                now = ticks_ms()
+                self.frame_ticks = now
+                self.ingest.frame(now)
 
-                data = data.split(b",")
-                if data[0] == b"B":
+                if frame == FRAME_STRIKE:
                     # Bell strike data
-                    bell = data[1].decode()
-                    strike_ticks = int(data[2].decode())
+                    bell = self.uart_reader.fields[0]
+                    strike_ticks = self.uart_reader.fields[1]
 
                     if not self.log_file:
-                        # Rotate logs if > 12 hours since last touch
-                        if (
-                            self.touch_count == 0
-                            or (time() - self.touch_end_time) > 3600 * 12
-                        ):
+                        # Logs are normally rotated ahead of time by maintain(),
+                        # this only catches a strike arriving before it runs
+                        if self.rotation_due():
                             self.rotate_logs()
 
                         # Start new log
                         self.start_log(strike_ticks)
+                        self.ingest.start_touch(now, strike_ticks)
+
+                    self.ingest.strike(now, strike_ticks)
 
                     delta_ticks = ticks_diff(strike_ticks, self.touch_start_ticks)
-                    log = "{},{}\n".format(bell, delta_ticks)
-                    self.log_file.write(log)
+                    struct.pack_into(
+                        RECORD_FMT, self.strike_buf, self.strike_len, bell, delta_ticks
+                    )
+                    self.strike_len += RECORD_SIZE
+
+                    if self.live_clients:
+                        self.add_live_strike(bell, delta_ticks)
+
+                    if self.strike_count % INDEX_INTERVAL == 0:
+                        self.touch_index.append(delta_ticks)
+
+                    if (
+                        self.strike_len >= self.flush_size
+                        or self.strike_len + RECORD_SIZE > STRIKE_BUFFER_SIZE
+                        or ticks_diff(strike_ticks, self.flush_ticks)
+                        > self.flush_interval
+                    ):
+                        self.flush_strikes(strike_ticks)
 
                     self.strike_count += 1
                     self.bell_set.add(bell)
+                    self.touch_stats.add(bell, delta_ticks)
 
-                elif data[0] == b"D":
+                elif frame == FRAME_DELAYS:
                     # Reply to delay query request
-                    self.delays = [int(d) for d in data[1:]]
+                    reader = self.uart_reader
+                    self.delays = [reader.fields[i] for i in range(reader.nfields)]
                     self.event.set()
+        finally:
+            watchdog.cancel()
 
-            except asyncio.TimeoutError:
-                if self.log_file:
+    # End the touch being logged when no frame has been received for
+    # READ_TIMEOUT seconds
+    async def watchdog(self):
+        while True:
+            timeout = READ_TIMEOUT * 1000
+            if self.log_file:
+                idle = ticks_diff(ticks_ms(), self.frame_ticks)
+                if idle >= timeout:
+                    self.ingest.timeouts += 1
                     self.touch_end_time = time()
                     self.stop_log()
+                else:
+                    timeout -= idle
+
+            await asyncio.sleep(timeout / 1000)
+
+    # Background maintenance loop. Rotates logs while idle so that a fresh log
+    # directory is ready before the next touch, then deletes old archives
+    async def maintain(self):
+        while True:
+            try:
+                if self.log_file is None and self.rotation_due():
+                    self.rotate_logs()
+
+                await self.clean_archives()
+            except OSError as e:
+                print("Log maintenance failed:", e)
+
+            await asyncio.sleep(MAINTAIN_INTERVAL)
+
+    # Logs need rotating if the current log directory has entries from a
+    # previous run or session
+    def rotation_due(self):
+        return self.log_index["log"] != 0 and (
+            self.touch_count == 0 or (time() - self.touch_end_time) > SESSION_GAP
+        )
+
+    # Archive directory has expired if there would be more than MAX_ARCHIVES
+    # after rotating
+    def archive_expired(self, dir):
+        return int(dir.split(".")[1]) > MAX_ARCHIVES - 1
+
+    # Delete expired archive directories, then the oldest archives while less
+    # than MIN_VFS_SPACE is free, yielding to other tasks after each file is
+    # removed. Directories are moved out of the archive sequence before any
+    # files are deleted, so logs can safely be rotated meanwhile
+    async def clean_archives(self):
+        while True:
+            if not self.expired_dirs:
+                dirs = self.get_archive_dirs()
+                if not dirs or self.get_vfs_free() >= MIN_VFS_SPACE:
+                    break
+
+                dirs.sort()
+                self.expire_archive_dir(dirs[-1])
+
+            dir = self.expired_dirs[0]
+            log_path = self.log_path(dir)
+            for f in os.listdir(log_path):
+                os.remove(self.log_path(dir, f))
+                await asyncio.sleep(0)
+
+            os.rmdir(log_path)
+            self.expired_dirs.remove(dir)
+
+        self.vfs_free = self.get_vfs_free()
+
+    # Ingest counters and histograms
+    def get_ingest_stats(self):
+        reader = self.uart_reader
+        ingest = self.ingest
+        return {
+            "frames": reader.frames,
+            "malformed": reader.malformed,
+            "unknown": reader.unknown,
+            "full_reads": reader.full_reads,
+            "timeouts": ingest.timeouts,
+            "live_dropped": self.live_dropped,
+            "rate_per_s": ingest.rate.result(),
+            "gap_ms": ingest.gap.result(),
+            "lag_ms": ingest.lag.result(),
+            "write_us": ingest.write_time.result(),
+            "rotate_us": ingest.rotate_time.result(),
+            "stop_us": ingest.stop_time.result(),
+        }
 
     def get_status(self):
         return "idle" if self.log_file is None else "logging"
 
+    # Current status, in the same form as a status event
+    def get_status_event(self):
+        return {"status": self.get_status(), "touch": self.touch_count}
+
+    # Add strike to live strike batch
+    def add_live_strike(self, bell, delta_ticks):
+        if self.live_count == LIVE_BATCH_STRIKES:
+            self.live_dropped += 1
+            return
+
+        offset = LIVE_HEADER_SIZE + self.live_count * RECORD_SIZE
+        struct.pack_into(RECORD_FMT, self.live_buf, offset, bell, delta_ticks)
+        self.live_count += 1
+
+        if self.live_count == LIVE_BATCH_STRIKES:
+            self.live_event.set()
+
+    # Take live strike batch (header followed by strike records), or None if
+    # there are no strikes waiting
+    def take_live_batch(self):
+        if self.live_count == 0:
+            return None
+
+        struct.pack_into(
+            LIVE_HEADER_FMT, self.live_buf, 0, self.touch_count, self.live_count
+        )
+        batch = self.live_buf[: LIVE_HEADER_SIZE + self.live_count * RECORD_SIZE]
+        self.live_count = 0
+
+        return batch
+
+    # Publish a status change event, dropping the oldest if nobody is reading
+    def publish_status(self, event):
+        if len(self.status_events) >= MAX_STATUS_EVENTS:
+            self.status_events.pop(0)
+
+        self.status_events.append(event)
+        self.status_event.set()
+
     # Start a new log file
     def start_log(self, start_ticks):
         if self.touch_count == 0:
@@ -88,72 +680,120 @@ class Logger:
 
         self.touch_count += 1
 
-        # Open new touch file and write header
-        self.log_file = open(self.touch_file(), "wt")
-        self.log_file.write("bell,ticks_ms\n")
+        # Open new (binary) touch file
+        self.log_file = open(self.touch_file(), "wb")
+        self.log_index["log"] += 1
+        self.latest_touch = self.touch_count
 
         # Reset touch info variables
+        self.strike_len = 0
+        self.touch_size = 0
+        self.flush_ticks = start_ticks
         self.strike_count = 0
         self.bell_set.clear()
+        self.touch_stats.reset()
+        self.touch_index = array.array("i")
         self.touch_start_ticks = ticks_diff(start_ticks, self.session_start_ticks)
 
+        self.publish_status({"status": "logging", "touch": self.touch_count})
+
+    # Write buffered strikes to touch file
+    def flush_strikes(self, ticks):
+        if self.strike_len:
+            start = ticks_us()
+            self.log_file.write(self.strike_mv[: self.strike_len])
+            self.ingest.write_time.add(ticks_diff(ticks_us(), start))
+            self.touch_size += self.strike_len
+            self.strike_len = 0
+
+        self.flush_ticks = ticks
+
     # Stop logging
     def stop_log(self):
-        # Close touch file
+        start = ticks_us()
+
+        # Flush strike buffer and close touch file
+        self.flush_strikes(self.flush_ticks)
         self.log_file.close()
         self.log_file = None
 
+        touch_num = self.touch_count
+        nrows = 0
         if self.strike_count < MIN_STRIKES:
             # Discard very short touches
             os.remove(self.touch_file())
             self.touch_count -= 1
+            self.log_index["log"] -= 1
+            self.latest_touch = self.touch_count
         else:
             # Update touch catalog
-            with open(self.catalog_file, "at") as f:
-                nrows = self.strike_count // len(self.bell_set)
+            nrows = self.strike_count // len(self.bell_set)
+            offset = self.catalog_csv_size(self.catalog_file)
+            with open(self.catalog_file, "ab") as f:
                 f.write(
-                    "{},{},{}\n".format(self.touch_count, nrows, self.touch_start_ticks)
+                    struct.pack(
+                        CATALOG_FMT,
+                        self.touch_count,
+                        nrows,
+                        self.touch_start_ticks,
+                        offset,
+                        self.strike_count,
+                    )
                 )
 
-    # Rotate (and delete) archive directories
+            # Save touch statistics and index
+            with open(self.stats_path(self.touch_count), "wt") as f:
+                json.dump(self.touch_stats.result(), f)
+
+            with open(self.index_path(self.touch_count), "wb") as f:
+                f.write(struct.pack(INDEX_HEADER_FMT, len(self.bell_set)))
+                f.write(self.touch_index)
+
+        self.vfs_free = self.get_vfs_free()
+
+        self.publish_status({"status": "idle", "touch": touch_num, "rows": nrows})
+        self.ingest.stop_time.add(ticks_diff(ticks_us(), start))
+
+    # Rotate archive directories, expiring the oldest
     def rotate_logs(self):
         # Do nothing if current log directory has no entries
-        entries = os.listdir(self.log_path("log"))
-        if sum(1 for e in entries if e.startswith("touch")) == 0:
+        if self.log_index["log"] == 0:
             return
 
-        # Delete old archives if less than half the disk space is left or there
-        # are more than MAX_ARCHIVES
-        dirs = self.get_archive_dirs()
-        dirs.sort(reverse=True)
-        for dir in dirs:
-            if self.get_vfs_free() < MIN_VFS_SPACE or int(dir[-1:]) > MAX_ARCHIVES - 1:
-                self.delete_archive_dir(dir)
+        start = ticks_us()
+
+        # Move expired archives out of the way, to be deleted by clean_archives()
+        for dir in self.get_archive_dirs():
+            if self.archive_expired(dir):
+                self.expire_archive_dir(dir)
 
         # Rotate archive dirs
         dirs = self.get_archive_dirs()
         dirs.sort(reverse=True)
         for d in dirs:
             base, ind = d.split(".")
-            os.rename(
-                self.log_path(d),
-                self.log_path("{}.{}".format(base, int(ind) + 1)),
-            )
+            new_dir = "{}.{}".format(base, int(ind) + 1)
+            os.rename(self.log_path(d), self.log_path(new_dir))
+            self.log_index[new_dir] = self.log_index.pop(d)
 
         # Archive current log dir and create a new one
         os.rename(self.log_path("log"), self.log_path("old-log.1"))
         os.mkdir(self.log_path("log"))
+        self.log_index["old-log.1"] = self.log_index["log"]
+        self.log_index["log"] = 0
 
-        # Create new catalog and write header
-        with open(self.catalog_file, "wt") as f:
-            f.write("touch,rows,start_ticks_ms\n")
+        # Create new (empty) catalog
+        open(self.catalog_file, "wb").close()
 
         # Reset touch count
         self.touch_count = 0
+        self.latest_touch = 0
+        self.vfs_free = self.get_vfs_free()
+        self.ingest.rotate_time.add(ticks_diff(ticks_us(), start))
 
     # Path of current touch log
     def touch_file(self):
-        return self.log_path("log", "touch_{:02d}.csv".format(self.touch_count))
+        return self.log_path("log", "touch_{:02d}.bin".format(self.touch_count))
 
     # Make full path of log dirs and files
     def log_path(self, *args):
@@ -175,19 +815,43 @@ class Logger:
 
     # Get archive log directories (ending in single digit number)
     def get_archive_dirs(self):
-        return [
-            d[0]
-            for d in os.ilistdir(self.root_dir)
-            if d[1] & S_IFDIR and d[0][-1].isdigit()
-        ]
+        return [d for d in self.log_index if d != "log"]
 
-    # Delete an archive directory
-    def delete_archive_dir(self, dir):
-        log_path = self.log_path(dir)
-        for f in os.listdir(log_path):
-            os.remove(self.log_path(dir, f))
+    # Rename an archive directory out of the archive sequence, and queue it to
+    # be deleted by clean_archives()
+    def expire_archive_dir(self, dir):
+        n = 1
+        while "expired{}{}".format(n, EXPIRED_SUFFIX) in self.expired_dirs:
+            n += 1
 
-        os.rmdir(log_path)
+        expired = "expired{}{}".format(n, EXPIRED_SUFFIX)
+        os.rename(self.log_path(dir), self.log_path(expired))
+        self.log_index.pop(dir)
+        self.expired_dirs.append(expired)
+
+    # Scan file system for log directories and count touches in each. Expired
+    # archives left by an interrupted clean up are queued to be deleted again
+    def build_log_index(self):
+        log_dirs = []
+        self.expired_dirs = []
+        for d in os.ilistdir(self.root_dir):
+            if d[1] & S_IFDIR:
+                if d[0][-1].isdigit():
+                    log_dirs.append(d[0])
+                elif d[0].endswith(EXPIRED_SUFFIX):
+                    self.expired_dirs.append(d[0])
+        log_dirs.append("log")
+
+        self.log_index = {}
+        self.latest_touch = 0
+        for d in log_dirs:
+            touches = [f for f in os.listdir(self.log_path(d)) if f.startswith("touch")]
+            self.log_index[d] = len(touches)
+
+            if d == "log" and touches:
+                self.latest_touch = max(int(f[6:-4]) for f in touches)
+
+        self.vfs_free = self.get_vfs_free()
 
     # Get number of touches in each log dir
     def get_log_info(self):
@@ -195,56 +859,432 @@ class Logger:
         log_dirs.sort()
         log_dirs.insert(0, "log")
 
-        # Count touch logs
-        touch_counts = [
-            sum(1 for f in os.listdir(self.log_path(d)) if f.startswith("touch"))
-            for d in log_dirs
-        ]
+        return zip(log_dirs, [self.log_index[d] for d in log_dirs])
+
+    # Get the first length (all if negative) records of the current log
+    # catalog as CSV text. Use generator to avoid memory issues
+    def get_catalog(self, length=-1):
+        return self.catalog_csv(self.catalog_file, length=length)
+
+    # Size of the first length (all if negative) records of the current log
+    # catalog as CSV text
+    def get_catalog_size(self, length=-1):
+        return self.catalog_csv_size(self.catalog_file, length)
+
+    # Number of touches in current log catalog
+    def get_catalog_length(self):
+        return self.catalog_length(self.catalog_file)
+
+    # Get limit (all if negative) entries of the current log catalog, starting
+    # at entry offset, as a JSON array
+    def get_catalog_json(self, offset=0, limit=-1):
+        yield "["
+
+        sep = ""
+        for touch, rows, start_ticks, _, strikes in self.catalog_entries(
+            self.catalog_file, offset, limit
+        ):
+            yield '{}{{"touch":{},"rows":{},"start_ticks_ms":{},"strikes":{}}}'.format(
+                sep, touch, rows, start_ticks, strikes
+            )
+            sep = ","
+
+        yield "]"
+
+    # Number of records in a catalog file
+    def catalog_length(self, filename):
+        try:
+            return os.stat(filename)[6] // CATALOG_SIZE
+        except OSError:
+            return 0
 
-        return zip(log_dirs, touch_counts)
+    # Read limit (all if negative) records of a catalog file, starting at
+    # record offset
+    def catalog_entries(self, filename, offset=0, limit=-1):
+        try:
+            f = open(filename, "rb")
+        except OSError:
+            return
+
+        with f:
+            f.seek(offset * CATALOG_SIZE)
+            while limit:
+                n = CATALOG_CHUNK if limit < 0 else min(CATALOG_CHUNK, limit)
+                data = f.read(n * CATALOG_SIZE)
+                if len(data) < CATALOG_SIZE:
+                    break
+
+                for i in range(0, len(data) - CATALOG_SIZE + 1, CATALOG_SIZE):
+                    yield struct.unpack_from(CATALOG_FMT, data, i)
+
+                if limit > 0:
+                    limit -= len(data) // CATALOG_SIZE
+
+    # Size of the first length (all if negative) records of a catalog file
+    # converted to CSV text, found from the last of those records
+    def catalog_csv_size(self, filename, length=-1):
+        if length < 0:
+            length = self.catalog_length(filename)
+        if length == 0:
+            return len(CATALOG_HEADER)
+
+        with open(filename, "rb") as f:
+            entry = self.read_catalog_entry(f, length - 1)
+
+        return entry[3] + len(catalog_line(entry))
+
+    # Read a single record from an open catalog file
+    def read_catalog_entry(self, f, index):
+        f.seek(index * CATALOG_SIZE)
+        return struct.unpack(CATALOG_FMT, f.read(CATALOG_SIZE))
+
+    # Convert the first length (all if negative) records of a catalog file to
+    # CSV text, starting at CSV byte offset start
+    def catalog_csv(self, filename, start=0, length=-1):
+        if length < 0:
+            length = self.catalog_length(filename)
+
+        first = 0
+        if start < len(CATALOG_HEADER):
+            yield CATALOG_HEADER[start:]
+            start = 0
+        else:
+            # Binary search for the record containing the start offset
+            lo = 0
+            hi = length
+            if hi > 1:
+                with open(filename, "rb") as f:
+                    while hi - lo > 1:
+                        mid = (lo + hi) // 2
+                        if self.read_catalog_entry(f, mid)[3] <= start:
+                            lo = mid
+                        else:
+                            hi = mid
+            first = lo
 
-    # Get current log catalog
-    def get_catalog(self):
-        with open(self.catalog_file, "rt") as catfile:
-            return catfile.read()
+        lines = []
+        for entry in self.catalog_entries(filename, first, length - first):
+            line = catalog_line(entry)
+            if start:
+                line = line[start - entry[3] :]
+                start = 0
 
-    # Get touch data. Use generator to avoid memory issues
-    async def get_touch_data(self, touch_num, chunksize=1024):
+            lines.append(line)
+            if len(lines) == CATALOG_CHUNK:
+                yield "".join(lines)
+                lines = []
+
+        if lines:
+            yield "".join(lines)
+
+    # Path of touch file, touch number 0 is the newest touch
+    def touch_path(self, touch_num):
         if touch_num == 0:
             # Get newest touch from current log directory
-            logs = [
-                d for d in os.listdir(self.log_path("log")) if d.startswith("touch")
-            ]
-            filename = sorted(logs)[-1]
+            touch_num = self.latest_touch
+
+        return self.log_path("log", "touch_{:02d}.bin".format(touch_num))
+
+    # Path of touch statistics file, touch number 0 is the newest touch
+    def stats_path(self, touch_num):
+        if touch_num == 0:
+            touch_num = self.latest_touch
+
+        return self.log_path("log", "stats_{:02d}.json".format(touch_num))
+
+    # Get touch statistics as JSON text. Statistics for the touch being logged
+    # are computed from the running totals
+    def get_touch_stats(self, touch_num):
+        if self.log_file and touch_num in (0, self.touch_count):
+            return json.dumps(self.touch_stats.result())
+
+        with open(self.stats_path(touch_num), "rt") as f:
+            return f.read()
+
+    # Path of touch index file, touch number 0 is the newest touch
+    def index_path(self, touch_num):
+        if touch_num == 0:
+            touch_num = self.latest_touch
+
+        return self.log_path("log", "index_{:02d}.bin".format(touch_num))
+
+    # Get number of bells and sparse ticks index of a touch
+    def get_touch_index(self, touch_num):
+        if self.log_file and touch_num in (0, self.touch_count):
+            return len(self.bell_set), self.touch_index
+
+        try:
+            with open(self.index_path(touch_num), "rb") as f:
+                nbells = struct.unpack(INDEX_HEADER_FMT, f.read(INDEX_HEADER_SIZE))[0]
+                return nbells, array.array("i", f.read())
+        except OSError:
+            # No index if logging the touch was interrupted
+            return self.scan_touch_index(touch_num)
+
+    # Build the number of bells and sparse ticks index of a touch from its
+    # touch file
+    def scan_touch_index(self, touch_num):
+        bells = set()
+        index = array.array("i")
+        record = 0
+        with open(self.touch_path(touch_num), "rb") as f:
+            while True:
+                data = f.read(INDEX_INTERVAL * RECORD_SIZE)
+                if len(data) < RECORD_SIZE:
+                    return len(bells), index
+
+                for i in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+                    bell, ticks = struct.unpack_from(RECORD_FMT, data, i)
+                    bells.add(bell)
+                    if record % INDEX_INTERVAL == 0:
+                        index.append(ticks)
+                    record += 1
+
+    # Size of the touch file and a copy of the strike records still in the
+    # strike buffer for the touch being logged, or None for other touches
+    def get_pending_strikes(self, touch_num):
+        if self.log_file and touch_num in (0, self.touch_count):
+            return self.touch_size, bytes(self.strike_mv[: self.strike_len])
+
+        return None
+
+    # Find the first strike record of a row, or the first strike at or after
+    # since_ticks. Returns the record number and number of bells
+    def find_touch_record(self, touch_num, row=None, since_ticks=None):
+        nbells, index = self.get_touch_index(touch_num)
+        if since_ticks is None:
+            return max(row, 0) * nbells, nbells
+
+        # Binary search for the last indexed record before since_ticks...
+        lo = 0
+        hi = len(index)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if index[mid] < since_ticks:
+                lo = mid + 1
+            else:
+                hi = mid
+        record = max(lo - 1, 0) * INDEX_INTERVAL
+
+        # ...then scan forward from it, through the touch file and any strikes
+        # still in the strike buffer
+        pending = self.get_pending_strikes(touch_num)
+        size = -1 if pending is None else pending[0]
+        with open(self.touch_path(touch_num), "rb") as f:
+            f.seek(record * RECORD_SIZE)
+            while size < 0 or record * RECORD_SIZE < size:
+                nbytes = INDEX_INTERVAL * RECORD_SIZE
+                if size >= 0:
+                    nbytes = min(nbytes, size - record * RECORD_SIZE)
+                data = f.read(nbytes)
+                if len(data) < RECORD_SIZE:
+                    break
+
+                for i in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+                    if struct.unpack_from(RECORD_FMT, data, i)[1] >= since_ticks:
+                        return record, nbells
+                    record += 1
+
+        if pending:
+            size, data = pending
+            record = max(record, size // RECORD_SIZE)
+            for i in range(record * RECORD_SIZE - size, len(data), RECORD_SIZE):
+                if struct.unpack_from(RECORD_FMT, data, i)[1] >= since_ticks:
+                    break
+                record += 1
+
+        return record, nbells
+
+    # Get touch file path, size and modification time
+    def get_touch_info(self, touch_num):
+        filename = self.touch_path(touch_num)
+        stat = os.stat(filename)
+
+        return filename, stat[6], stat[8]
+
+    # Get touch data (as CSV) starting at byte offset start and stopping at
+    # binary file position size if given, or count (all if negative) strike
+    # records starting at record first. Strikes of the touch being logged that
+    # are still in the strike buffer are only included in record slices. Use
+    # generator to avoid memory issues
+    async def get_touch_data(
+        self, touch_num, chunksize=1024, start=0, size=-1, first=None, count=-1
+    ):
+        filename = self.touch_path(touch_num)
+
+        pending = None
+        if first is None:
+            first = 0
         else:
-            filename = self.log_path("log", "touch_{:02d}.csv".format(touch_num))
+            if count >= 0:
+                size = (first + count) * RECORD_SIZE
+            pending = self.get_pending_strikes(touch_num)
+
+        if pending:
+            # Read the touch file only up to the buffered strikes
+            written, buffered = pending
+            size = written if size < 0 else min(size, written)
 
         try:
-            with open(filename) as f:
-                while True:
-                    data = f.read(chunksize)
-                    if not data:
-                        break
-                    yield data
+            for data in self.touch_csv(
+                filename, chunksize, size, start, first * RECORD_SIZE
+            ):
+                yield data
         except OSError:
             yield ""
 
+        if pending:
+            end = len(buffered)
+            if count >= 0:
+                end = min(end, (first + count) * RECORD_SIZE - written)
+            pos = max(first * RECORD_SIZE - written, 0)
+            if pos < end:
+                yield records_csv(buffered[pos:end])
+
+    # Convert binary touch file to CSV text, in chunks of (roughly) chunksize,
+    # starting at CSV byte offset start, or at binary file position pos if
+    # start is within the header. Stops at binary file position size if given
+    def touch_csv(self, filename, chunksize=1024, size=-1, start=0, pos=0):
+        # Allow ~10 characters per CSV line
+        nbytes = max(1, chunksize // 10) * RECORD_SIZE
+
+        with open(filename, "rb") as f:
+            skip = 0
+            if start < len(CSV_HEADER):
+                yield CSV_HEADER[start:]
+            else:
+                # Find the record containing the start offset
+                pos, skip = self.find_csv_offset(f, start - len(CSV_HEADER))
+
+            f.seek(pos)
+            if size > 0:
+                size = max(size - pos, 0)
+
+            while size:
+                data = f.read(nbytes if size < 0 else min(nbytes, size))
+                if not data:
+                    break
+                size -= len(data)
+
+                text = records_csv(data)
+                if skip:
+                    text = text[skip:]
+                    skip = 0
+                yield text
+
+    # Find the binary file position of the record containing CSV data offset
+    # (excluding header) and the offset within the record's CSV line
+    def find_csv_offset(self, f, offset):
+        pos = 0
+        while True:
+            data = f.read(64 * RECORD_SIZE)
+            if len(data) < RECORD_SIZE:
+                return pos, 0
+
+            for i in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+                bell, ticks = struct.unpack_from(RECORD_FMT, data, i)
+                line_len = ndigits(bell) + ndigits(ticks) + 2
+                if offset < line_len:
+                    return pos, offset
+
+                offset -= line_len
+                pos += RECORD_SIZE
+
+    # Get size of CSV converted touch file and size of the binary data used,
+    # reading at most size bytes of the binary file if size is given
+    def touch_csv_size(self, filename, size=-1):
+        csv_size = len(CSV_HEADER)
+        bin_size = 0
+        with open(filename, "rb") as f:
+            while bin_size != size:
+                nbytes = 64 * RECORD_SIZE
+                data = f.read(nbytes if size < 0 else min(nbytes, size - bin_size))
+                if len(data) < RECORD_SIZE:
+                    break
+
+                for i in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+                    bell, ticks = struct.unpack_from(RECORD_FMT, data, i)
+                    csv_size += ndigits(bell) + ndigits(ticks) + 2
+                    bin_size += RECORD_SIZE
+
+        return csv_size, bin_size
+
+    # Get tar archive of a log directory. Returns archive size, latest
+    # modification time and the archive entries for tar_data
     def make_tar(self, log_dir):
-        tar_path = self.log_path("download.tar")
-        with tarfile.TarFile(tar_path, "w") as tf:
-            for log in os.listdir(self.log_path(log_dir)):
-                filename = self.log_path(log_dir, log)
-                stat = os.stat(filename)
-
-                tarinfo = tarfile.TarInfo(log)
-                tarinfo.uid = stat[4]
-                tarinfo.gid = stat[5]
-                tarinfo.size = stat[6]
-                tarinfo.mtime = stat[8]
-                with open(filename) as f:
-                    tf.addfile(tarinfo, f)
-
-        return tar_path
+        entries = []
+
+        # Size includes two zero blocks for end of archive
+        tar_size = 2 * TAR_BLOCK_SIZE
+        mtime = 0
+        for log in sorted(os.listdir(self.log_path(log_dir))):
+            if log.startswith("index"):
+                # Touch indexes are only used by the server
+                continue
+
+            filename = self.log_path(log_dir, log)
+            stat = os.stat(filename)
+
+            if log.startswith("touch"):
+                # Binary touch data is converted to CSV
+                size, bin_size = self.touch_csv_size(filename)
+                log = log[:-4] + ".csv"
+            elif log == "_logcat.bin":
+                # And so is the binary catalog
+                bin_size = stat[6]
+                size = self.catalog_csv_size(filename, bin_size // CATALOG_SIZE)
+                log = "_logcat.csv"
+            else:
+                size = bin_size = stat[6]
+
+            entries.append((filename, log, size, bin_size, stat[8]))
+            tar_size += TAR_BLOCK_SIZE + tar_padded(size)
+            mtime = max(mtime, stat[8])
+
+        return tar_size, mtime, entries
+
+    # Stream tar archive data, starting at byte offset start
+    def tar_data(self, entries, chunksize=1024, start=0):
+        for filename, name, size, bin_size, mtime in entries:
+            if start >= TAR_BLOCK_SIZE + tar_padded(size):
+                # Skip whole entry
+                start -= TAR_BLOCK_SIZE + tar_padded(size)
+                continue
+
+            if start < TAR_BLOCK_SIZE:
+                yield tar_header(name, size, mtime)[start:]
+                start = 0
+            else:
+                start -= TAR_BLOCK_SIZE
+
+            if start < size:
+                if name.startswith("touch"):
+                    for data in self.touch_csv(filename, chunksize, bin_size, start):
+                        yield data
+                elif filename.endswith("_logcat.bin"):
+                    length = bin_size // CATALOG_SIZE
+                    for data in self.catalog_csv(filename, start, length):
+                        yield data
+                else:
+                    with open(filename, "rb") as f:
+                        f.seek(start)
+                        bin_size -= start
+                        while bin_size:
+                            data = f.read(min(chunksize, bin_size))
+                            if not data:
+                                break
+                            bin_size -= len(data)
+                            yield data
+                start = 0
+            else:
+                start -= size
+
+            if tar_padded(size) - size > start:
+                yield bytes(tar_padded(size) - size - start)
+            start = 0
+
+        if start < 2 * TAR_BLOCK_SIZE:
+            yield bytes(2 * TAR_BLOCK_SIZE - start)
 
     # Get bell delays from CAN interface
     async def get_delays(self):
@@ -26,10 +26,10 @@ async def start():
     uart = machine.UART(1, tx=4, rx=5)
     log = logger.Logger(uart, "log")
 
-    app = webserver.create_app(log)
+    app = webserver.create_app(log, metrics=True)
     ws = app.start_server(port=80)
 
-    await asyncio.gather(ws, log.log())
+    await asyncio.gather(ws, log.log(), log.maintain())
 
 
 asyncio.run(start())
@@ -0,0 +1,202 @@
+from microdot.microdot import Response
+
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:  # pragma: no cover
+    import time
+
+    def ticks_us():
+        return int(time.monotonic() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+#: The default upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class _CountingStream:
+    """A wrapper for a response stream that counts the bytes written."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    async def awrite(self, data):
+        self.count += len(data)
+        await self.stream.awrite(data)
+
+
+class Metrics:
+    """Collect request metrics and serve them in the Prometheus text
+    exposition format.
+
+    :param app: The application instance to add metrics to.
+    :param path: The URL path of the metrics endpoint. Set to ``None`` to
+                 not add an endpoint, and call :meth:`generate` from a route
+                 of your own instead.
+    :param buckets: The upper bounds of the latency histogram buckets, in
+                    seconds.
+
+    The following series are collected:
+
+    - ``http_requests_total``: requests by route pattern and status code.
+    - ``http_request_duration_seconds``: latency histogram by route pattern,
+      including the time taken to send the response body.
+    - ``http_response_bytes_total``: bytes sent by route pattern.
+    - ``http_connections_active``: open client connections.
+    - ``http_websockets_active``: open WebSocket connections.
+    - ``http_requests_in_flight``: requests being handled.
+
+    Requests that do not match a route are counted with a route label of
+    ``none``. Memory use is constant for a given set of routes and status
+    codes.
+
+    Example::
+
+        app = Microdot()
+        Metrics(app)
+    """
+    def __init__(self, app=None, path='/metrics', buckets=LATENCY_BUCKETS):
+        self.path = path
+        self.buckets = buckets
+        self.buckets_us = [int(bound * 1000000) for bound in buckets]
+        self.requests = {}
+        self.latency = {}
+        self.bytes_sent = {}
+        self.connections = 0
+        self.websockets = 0
+        self.in_flight = 0
+        if app:
+            self.initialize(app)
+
+    def initialize(self, app):
+        """Add metrics collection to an application.
+
+        :param app: The application instance.
+        """
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.after_error_request(self.after_request)
+
+        handle_request = app.handle_request
+
+        async def counted_handle_request(reader, writer):
+            self.connections += 1
+            try:
+                await handle_request(reader, writer)
+            finally:
+                self.connections -= 1
+
+        app.handle_request = counted_handle_request
+
+        if self.path:
+            @app.get(self.path)
+            async def metrics(request):
+                return self.generate(), 200, {
+                    'Content-Type': 'text/plain; version=0.0.4'}
+
+    async def before_request(self, request):
+        request._metrics_start = ticks_us()
+        request._metrics_websocket = \
+            request.headers.get('Upgrade', '').lower() == 'websocket'
+        if request._metrics_websocket:
+            self.websockets += 1
+        else:
+            self.in_flight += 1
+
+    async def after_request(self, request, response):
+        start = getattr(request, '_metrics_start', None)
+        websocket = getattr(request, '_metrics_websocket', False)
+        if start is None:
+            # no route was matched, so the before request handler did not run
+            start = ticks_us()
+            self.in_flight += 1
+        elif websocket:
+            self.websockets -= 1
+            self.in_flight += 1
+
+        route = request.url_pattern if request is not None else None
+        if response == Response.already_handled:
+            # the handler took over the connection, for example to upgrade it
+            # to a WebSocket, so there is no response to measure
+            self.in_flight -= 1
+            self._count(route, 101 if websocket else response.status_code)
+            return response
+
+        write = response.write
+
+        async def measured_write(stream):
+            counting_stream = _CountingStream(stream)
+            try:
+                await write(counting_stream)
+            finally:
+                self.in_flight -= 1
+                self._record(route, response.status_code, start,
+                             counting_stream.count)
+
+        response.write = measured_write
+        return response
+
+    def generate(self):
+        """Return the collected metrics in the Prometheus text exposition
+        format."""
+        lines = ['# TYPE http_requests_total counter']
+        for (route, status), count in self.requests.items():
+            lines.append('http_requests_total{{route="{}",status="{}"}} '
+                         '{}'.format(self._label(route), status, count))
+
+        lines.append('# TYPE http_request_duration_seconds histogram')
+        for route, (counts, total) in self.latency.items():
+            label = self._label(route)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('http_request_duration_seconds_bucket'
+                             '{{route="{}",le="{}"}} {}'.format(
+                                 label, bound, cumulative))
+            cumulative += counts[-1]
+            lines.append('http_request_duration_seconds_bucket'
+                         '{{route="{}",le="+Inf"}} {}'.format(
+                             label, cumulative))
+            lines.append('http_request_duration_seconds_sum'
+                         '{{route="{}"}} {}'.format(label, total[0] / 1e6))
+            lines.append('http_request_duration_seconds_count'
+                         '{{route="{}"}} {}'.format(label, cumulative))
+
+        lines.append('# TYPE http_response_bytes_total counter')
+        for route, count in self.bytes_sent.items():
+            lines.append('http_response_bytes_total{{route="{}"}} {}'.format(
+                self._label(route), count))
+
+        lines.append('# TYPE http_connections_active gauge')
+        lines.append('http_connections_active {}'.format(self.connections))
+        lines.append('# TYPE http_websockets_active gauge')
+        lines.append('http_websockets_active {}'.format(self.websockets))
+        lines.append('# TYPE http_requests_in_flight gauge')
+        lines.append('http_requests_in_flight {}'.format(self.in_flight))
+        return '\n'.join(lines) + '\n'
+
+    def _count(self, route, status_code):
+        key = (route, status_code)
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+    def _record(self, route, status_code, start, nbytes):
+        self._count(route, status_code)
+        elapsed = ticks_diff(ticks_us(), start)
+        if route not in self.latency:
+            self.latency[route] = ([0] * (len(self.buckets) + 1), [0])
+        counts, total = self.latency[route]
+        i = 0
+        for bound in self.buckets_us:
+            if elapsed <= bound:
+                break
+            i += 1
+        counts[i] += 1
+        total[0] += elapsed
+        self.bytes_sent[route] = self.bytes_sent.get(route, 0) + nbytes
+
+    @staticmethod
+    def _label(route):
+        if route is None:
+            return 'none'
+        return route.replace('\\', '\\\\').replace('"', '\\"')
@@ -8,6 +8,7 @@ servers for MicroPython and standard Python.
 import asyncio
 import io
 import json
+import os
 import time
 
 try:
@@ -94,6 +95,35 @@ def urlencode(s):
             '&', '%26').replace('=', '%3D')
 
 
+def parse_range(value, size):
+    """Parse the value of a ``Range`` header.
+
+    :param value: The header value.
+    :param size: The size in bytes of the complete resource.
+
+    Returns the first and last byte positions of the requested range, as a
+    tuple. ``None`` is returned if the header should be ignored and the
+    complete resource sent, which includes requests for multiple ranges.
+    ``False`` is returned if the range cannot be satisfied.
+    """
+    if not value.startswith('bytes=') or ',' in value:
+        return None
+    try:
+        start, end = value[6:].strip().split('-', 1)
+        if start == '':
+            # suffix range, the last bytes of the resource
+            start = max(size - int(end), 0)
+            end = size - 1
+        else:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
 class NoCaseDict(dict):
     """A subclass of dictionary that holds case-insensitive keys.
 
@@ -294,6 +324,123 @@ class AsyncBytesIO:
         pass
 
 
+class BufferedStream:
+    """A wrapper for a connection's input stream that reads the request
+    headers in bulk.
+
+    :param stream: The input stream of the connection.
+    :param size: The number of bytes requested from the stream in each read.
+
+    Bytes that are read past the end of the headers are kept and returned by
+    the following reads, so the same object must be used for the whole life
+    of the connection.
+    """
+    def __init__(self, stream, size=512):
+        self.stream = stream
+        self.size = size
+        self.buf = b''
+
+    async def read_headers(self, max_length):
+        """Return the request line and headers, up to the blank line that
+        ends them. An empty block is returned if the connection is closed
+        before a request arrives."""
+        start = 0
+        while True:
+            end = self.buf.find(b'\n\r\n', start)
+            skip = 3
+            if end == -1:
+                end = self.buf.find(b'\n\n', start)
+                skip = 2
+            if end != -1:
+                block = self.buf[:end]
+                self.buf = self.buf[end + skip:]
+                return block
+            if len(self.buf) > max_length:
+                raise ValueError('headers too long')
+            start = max(len(self.buf) - 2, 0)
+            data = await self.stream.read(self.size)
+            if not data:
+                block = self.buf
+                self.buf = b''
+                return block
+            self.buf = self.buf + data if self.buf else data
+
+    async def read(self, n=-1):
+        if not self.buf:
+            return await self.stream.read(n)
+        if n < 0 or n >= len(self.buf):
+            data = self.buf
+            self.buf = b''
+        else:
+            data = self.buf[:n]
+            self.buf = self.buf[n:]
+        return data
+
+    async def readexactly(self, n):
+        data = await self.read(n)
+        if len(data) < n:
+            data += await self.stream.readexactly(n - len(data))
+        return data
+
+    async def readline(self):
+        end = self.buf.find(b'\n')
+        if end == -1:
+            data = self.buf
+            self.buf = b''
+            return data + await self.stream.readline()
+        data = self.buf[:end + 1]
+        self.buf = self.buf[end + 1:]
+        return data
+
+
+class RangeBody:
+    """A response body that is limited to a given number of bytes.
+
+    :param body: A file-like object, generator or async generator with the
+                 body contents, starting at the first byte of the range.
+    :param length: The number of bytes to send.
+    """
+    def __init__(self, body, length):
+        self.body = body
+        self.length = length
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.length <= 0:
+            raise StopAsyncIteration
+        if hasattr(self.body, 'read'):
+            buf = self.body.read(
+                min(Response.send_file_buffer_size, self.length))
+            if iscoroutine(buf):  # pragma: no cover
+                buf = await buf
+            if not buf:
+                raise StopAsyncIteration
+        elif hasattr(self.body, '__anext__'):
+            buf = await self.body.__anext__()
+        else:
+            try:
+                buf = next(self.body)
+            except StopIteration:
+                raise StopAsyncIteration
+        if isinstance(buf, str):
+            buf = buf.encode()
+        buf = buf[:self.length]
+        self.length -= len(buf)
+        return buf
+
+    async def aclose(self):
+        if hasattr(self.body, 'aclose'):
+            await self.body.aclose()
+        elif hasattr(self.body, 'close'):
+            self.body.close()
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+
 class Request:
     """An HTTP request."""
     #: Specify the maximum payload size that is accepted. Requests with larger
@@ -325,6 +472,15 @@ class Request:
     #:    Request.max_readline = 16 * 1024  # 16KB lines allowed
     max_readline = 2 * 1024
 
+    #: Specify the maximum size of the request line and headers combined.
+    #: Requests with a larger header block will not be correctly interpreted.
+    #: Applications can change this maximum as necessary.
+    #:
+    #: Example::
+    #:
+    #:    Request.max_header_length = 8 * 1024  # 8KB header blocks allowed
+    max_header_length = 4 * 1024
+
     class G:
         pass
 
@@ -340,6 +496,9 @@ class Request:
         self.url = url
         #: The path portion of the URL.
         self.path = url
+        #: The URL pattern of the route that matched the request, or ``None``
+        #: if no route matched.
+        self.url_pattern = None
         #: The query string portion of the URL.
         self.query_string = None
         #: The parsed query string, as a
@@ -393,26 +552,31 @@ class Request:
         This method is a coroutine. It returns a newly created ``Request``
         object.
         """
-        # request line
-        line = (await Request._safe_readline(client_reader)).strip().decode()
+        if not isinstance(client_reader, BufferedStream):
+            client_reader = BufferedStream(client_reader)
+
+        # request line and headers are read and decoded as a single block
+        block = await client_reader.read_headers(Request.max_header_length)
+        lines = block.decode().split('\n')
+        for line in lines:
+            if len(line) > Request.max_readline:
+                raise ValueError('line too long')
+        line = lines.pop(0).strip()
         if not line:  # pragma: no cover
             return None
         method, url, http_version = line.split()
         http_version = http_version.split('/', 1)[1]
 
-        # headers
-        headers = NoCaseDict()
-        content_length = 0
-        while True:
-            line = (await Request._safe_readline(
-                client_reader)).strip().decode()
-            if line == '':
-                break
+        # header names are lower-cased once, so that lookups in the
+        # NoCaseDict do not need to map them again
+        headers = {}
+        for line in lines:
+            if not line.strip():
+                continue
             header, value = line.split(':', 1)
-            value = value.strip()
-            headers[header] = value
-            if header.lower() == 'content-length':
-                content_length = int(value)
+            headers[header.lower()] = value.strip()
+        headers = NoCaseDict(headers)
+        content_length = int(headers.get('content-length', 0))
 
         # body
         body = b''
@@ -506,13 +670,6 @@ class Request:
         self.after_request_handlers.append(f)
         return f
 
-    @staticmethod
-    async def _safe_readline(stream):
-        line = (await stream.readline())
-        if len(line) > Request.max_readline:
-            raise ValueError('line too long')
-        return line
-
 
 class Response:
     """An HTTP response class.
@@ -542,6 +699,15 @@ class Response:
 
     send_file_buffer_size = 1024
 
+    #: The minimum size of a chunk sent with chunked transfer encoding.
+    #: Smaller pieces of a streamed response body are combined until they
+    #: reach this size.
+    #:
+    #: Example::
+    #:
+    #:    Response.chunk_min_size = 1024
+    chunk_min_size = 512
+
     #: The content type to use for responses that do not explicitly define a
     #: ``Content-Type`` header.
     default_content_type = 'text/plain'
@@ -570,6 +736,7 @@ class Response:
             # this applies to bytes, file-like objects or generators
             self.body = body
         self.is_head = False
+        self.http_version = '1.0'
 
     def set_cookie(self, cookie, value, path=None, domain=None, expires=None,
                    max_age=None, secure=False, http_only=False,
@@ -625,6 +792,10 @@ class Response:
         if isinstance(self.body, bytes) and \
                 'Content-Length' not in self.headers:
             self.headers['Content-Length'] = str(len(self.body))
+        elif self.http_version == '1.1' and not self.is_head and \
+                'Content-Length' not in self.headers:
+            # streamed body of unknown length
+            self.headers['Transfer-Encoding'] = 'chunked'
         if 'Content-Type' not in self.headers:
             self.headers['Content-Type'] = self.default_content_type
             if 'charset=' not in self.headers['Content-Type']:
@@ -637,23 +808,43 @@ class Response:
             # status code
             reason = self.reason if self.reason is not None else \
                 ('OK' if self.status_code == 200 else 'N/A')
-            await stream.awrite('HTTP/1.0 {status_code} {reason}\r\n'.format(
-                status_code=self.status_code, reason=reason).encode())
+            head = bytearray(
+                'HTTP/{http_version} {status_code} {reason}\r\n'.format(
+                    http_version=self.http_version,
+                    status_code=self.status_code, reason=reason).encode())
 
             # headers
             for header, value in self.headers.items():
                 values = value if isinstance(value, list) else [value]
                 for value in values:
-                    await stream.awrite('{header}: {value}\r\n'.format(
+                    head.extend('{header}: {value}\r\n'.format(
                         header=header, value=value).encode())
-            await stream.awrite(b'\r\n')
+            head.extend(b'\r\n')
+
+            # the status line, headers and a small body are sent in a single
+            # write
+            body_sent = self.is_head
+            if not body_sent and isinstance(self.body, bytes) and \
+                    len(self.body) <= self.send_file_buffer_size:
+                head.extend(self.body)
+                body_sent = True
+            await stream.awrite(head)
 
             # body
-            if not self.is_head:
+            if not body_sent:
+                chunked = self.headers.get('Transfer-Encoding') == 'chunked'
+                pending = bytearray()
                 iter = self.body_iter()
                 async for body in iter:
                     if isinstance(body, str):  # pragma: no cover
                         body = body.encode()
+                    if chunked:
+                        # combine small pieces into larger chunks
+                        pending.extend(body)
+                        if len(pending) < self.chunk_min_size:
+                            continue
+                        body = self._encode_chunk(pending)
+                        pending = bytearray()
                     try:
                         await stream.awrite(body)
                     except OSError as exc:  # pragma: no cover
@@ -664,6 +855,11 @@ class Response:
                         raise
                 if hasattr(iter, 'aclose'):  # pragma: no branch
                     await iter.aclose()
+                if chunked:
+                    # remaining data and last (empty) chunk
+                    await stream.awrite(
+                        (self._encode_chunk(pending) if pending else b'') +
+                        b'0\r\n\r\n')
 
         except OSError as exc:  # pragma: no cover
             if exc.errno in MUTED_SOCKET_ERRORS or \
@@ -672,6 +868,63 @@ class Response:
             else:
                 raise
 
+    def set_range(self, request, size, body_range=None):
+        """Honour a ``Range`` header in the request, turning this response
+        into a partial response.
+
+        :param request: The request object.
+        :param size: The size in bytes of the complete response body.
+        :param body_range: A function that receives the start position of the
+                           range and returns a file-like object, generator or
+                           async generator with the body from that position.
+                           If not given, byte bodies are sliced and file-like
+                           bodies are seeked to the start position.
+
+        The ``Range`` header is ignored if the response is not a 200 response,
+        or if the request has an ``If-Range`` header that does not match the
+        ``ETag`` or ``Last-Modified`` headers of this response. This method
+        returns the response object.
+        """
+        self.headers['Accept-Ranges'] = 'bytes'
+        value = request.headers.get('Range')
+        if value is None or self.status_code != 200:
+            return self
+        if_range = request.headers.get('If-Range')
+        if if_range is not None and if_range not in (
+                self.headers.get('ETag'), self.headers.get('Last-Modified')):
+            return self
+        range_ = parse_range(value, size)
+        if range_ is None:
+            return self
+        if hasattr(self.body, 'close') and (
+                range_ is False or body_range is not None):
+            self.body.close()
+        if range_ is False:
+            self.status_code = 416
+            self.body = b''
+            self.headers['Content-Range'] = 'bytes */{}'.format(size)
+            self.headers['Content-Length'] = '0'
+            return self
+        start, end = range_
+        length = end - start + 1
+        if body_range is not None:
+            self.body = RangeBody(body_range(start), length)
+        elif isinstance(self.body, bytes):
+            self.body = self.body[start:end + 1]
+        else:
+            self.body.seek(start)
+            self.body = RangeBody(self.body, length)
+        self.status_code = 206
+        self.reason = 'Partial Content'
+        self.headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+            start, end, size)
+        self.headers['Content-Length'] = str(length)
+        return self
+
+    @staticmethod
+    def _encode_chunk(data):
+        return '{:x}\r\n'.format(len(data)).encode() + data + b'\r\n'
+
     def body_iter(self):
         if hasattr(self.body, '__anext__'):
             # response body is an async generator
@@ -741,7 +994,7 @@ class Response:
     @classmethod
     def send_file(cls, filename, status_code=200, content_type=None,
                   stream=None, max_age=None, compressed=False,
-                  file_extension=''):
+                  file_extension='', request=None):
         """Send file contents in a response.
 
         :param filename: The filename of the file.
@@ -768,6 +1021,9 @@ class Response:
                                parameter when opening the file, including the
                                dot. The extension given here is not considered
                                when generating the ``Content-Type`` header.
+        :param request: The request object. If given, a ``Range`` header in
+                        the request is honoured and a partial response is
+                        returned. This is not supported for streams.
 
         Security note: The filename is assumed to be trusted. Never pass
         filenames provided by the user without validating and sanitizing them
@@ -794,13 +1050,21 @@ class Response:
                 if isinstance(compressed, str) else 'gzip'
 
         f = stream or open(filename + file_extension, 'rb')
-        return cls(body=f, status_code=status_code, headers=headers)
+        res = cls(body=f, status_code=status_code, headers=headers)
+        if request is not None and stream is None:
+            size = os.stat(filename + file_extension)[6]
+            res.headers['Content-Length'] = str(size)
+            res.set_range(request, size)
+        return res
 
 
 class URLPattern():
     def __init__(self, url_pattern):
         self.url_pattern = url_pattern
         self.segments = []
+        #: The segments of the pattern, as ``(text, type, name)`` tuples.
+        #: Static segments have a ``type`` of ``None``.
+        self.parts = []
         self.regex = None
         pattern = ''
         use_regex = False
@@ -831,9 +1095,11 @@ class URLPattern():
                     raise ValueError('invalid URL segment type')
                 self.segments.append({'parser': parser, 'name': name,
                                       'type': type_})
+                self.parts.append((None, type_, name))
             else:
                 pattern += '/' + segment
                 self.segments.append({'parser': self._static_segment(segment)})
+                self.parts.append((segment, None, None))
         if use_regex:
             import re
             self.regex = re.compile('^' + pattern + '$')
@@ -870,6 +1136,13 @@ class URLPattern():
                 return
         return args
 
+    def static_path(self):
+        """Return the only path matched by this pattern, or ``None`` if the
+        pattern has dynamic segments."""
+        if any(type_ is not None for _, type_, _ in self.parts):
+            return None
+        return '/' + '/'.join(text for text, _, _ in self.parts)
+
     def _static_segment(self, segment):
         def _static(value):
             s = value.split('/', 1)
@@ -914,9 +1187,26 @@ class Microdot:
 
         app = Microdot()
     """
+    #: Specify the time in seconds that a persistent (keep-alive) connection
+    #: is kept open while waiting for the next request. Set to 0 to close the
+    #: connection after each response.
+    #:
+    #: Example::
+    #:
+    #:    Microdot.keep_alive_timeout = 10
+    keep_alive_timeout = 5
+
+    #: Specify the maximum number of requests that are handled on a single
+    #: persistent connection before it is closed.
+    #:
+    #: Example::
+    #:
+    #:    Microdot.max_keep_alive_requests = 10
+    max_keep_alive_requests = 20
 
     def __init__(self):
         self.url_map = []
+        self.route_index = None
         self.before_request_handlers = []
         self.after_request_handlers = []
         self.after_error_request_handlers = []
@@ -960,6 +1250,7 @@ class Microdot:
             self.url_map.append(
                 ([m.upper() for m in (methods or ['GET'])],
                  URLPattern(url_pattern), f))
+            self.route_index = None
             return f
         return decorated
 
@@ -1137,6 +1428,7 @@ class Microdot:
             self.url_map.append(
                 (methods, URLPattern(url_prefix + pattern.url_pattern),
                  handler))
+        self.route_index = None
         for handler in subapp.before_request_handlers:
             self.before_request_handlers.append(handler)
         for handler in subapp.after_request_handlers:
@@ -1306,37 +1598,140 @@ class Microdot:
         if method == 'HEAD':
             method = 'GET'
         f = 404
-        for route_methods, route_pattern, route_handler in self.url_map:
-            req.url_args = route_pattern.match(req.path)
-            if req.url_args is not None:
-                if method in route_methods:
-                    f = route_handler
-                    break
-                else:
-                    f = 405
+        req.url_args = None
+        best = None
+        for index, args in self.match_routes(req.path):
+            if method in self.url_map[index][0]:
+                if best is None or index < best:
+                    best = index
+                    req.url_args = args
+            else:
+                f = 405
+        if best is not None:
+            f = self.url_map[best][2]
+            req.url_pattern = self.url_map[best][1].url_pattern
         return f
 
+    def match_routes(self, path):
+        """Return the routes that match a path, as a list of
+        ``(index, args)`` tuples, where ``index`` is the position of the route
+        in ``url_map`` and ``args`` are the arguments parsed from the path.
+
+        Routes are looked up in an index that is built the first time this
+        method is called, with a hash table for static routes and a segment
+        tree for routes with string and integer arguments. Routes with path
+        or regular expression arguments are matched one by one.
+        """
+        if self.route_index is None:
+            self.route_index = self._build_route_index()
+        static, tree, regex_routes = self.route_index
+        matches = [(index, {}) for index in static.get(path, [])]
+        if path and path[0] == '/':
+            self._match_tree(tree, path[1:].split('/'), 0, {}, matches)
+        for index in regex_routes:
+            args = self.url_map[index][1].match(path)
+            if args is not None:
+                matches.append((index, args))
+        return matches
+
+    def _build_route_index(self):
+        # tree nodes are [static children, argument children, route indexes]
+        static = {}
+        tree = [{}, [], []]
+        regex_routes = []
+        for index, (_, pattern, _) in enumerate(self.url_map):
+            path = pattern.static_path()
+            if path is not None:
+                static.setdefault(path, []).append(index)
+            elif pattern.regex:
+                regex_routes.append(index)
+            else:
+                node = tree
+                for text, type_, name in pattern.parts:
+                    if type_ is None:
+                        node = node[0].setdefault(text, [{}, [], []])
+                    else:
+                        for child_type, child_name, child in node[1]:
+                            if child_type == type_ and child_name == name:
+                                node = child
+                                break
+                        else:
+                            child = [{}, [], []]
+                            node[1].append((type_, name, child))
+                            node = child
+                node[2].append(index)
+        return static, tree, regex_routes
+
+    def _match_tree(self, node, segments, i, args, matches):
+        if i == len(segments):
+            for index in node[2]:
+                matches.append((index, args))
+            return
+        segment = segments[i]
+        child = node[0].get(segment)
+        if child is not None:
+            self._match_tree(child, segments, i + 1, args, matches)
+        for type_, name, child in node[1]:
+            if type_ == 'int':
+                try:
+                    value = int(segment)
+                except ValueError:
+                    continue
+            elif segment:
+                value = segment
+            else:
+                continue
+            child_args = args.copy()
+            child_args[name] = value
+            self._match_tree(child, segments, i + 1, child_args, matches)
+
     def default_options_handler(self, req):
         allow = []
-        for route_methods, route_pattern, route_handler in self.url_map:
-            if route_pattern.match(req.path) is not None:
-                allow.extend(route_methods)
+        for index, _ in sorted(self.match_routes(req.path)):
+            allow.extend(self.url_map[index][0])
         if 'GET' in allow:
             allow.append('HEAD')
         allow.append('OPTIONS')
         return {'Allow': ', '.join(allow)}
 
     async def handle_request(self, reader, writer):
-        req = None
-        try:
-            req = await Request.create(self, reader, writer,
-                                       writer.get_extra_info('peername'))
-        except Exception as exc:  # pragma: no cover
-            print_exception(exc)
-
-        res = await self.dispatch_request(req)
-        if res != Response.already_handled:  # pragma: no branch
-            await res.write(writer)
+        reader = BufferedStream(reader)
+        count = 0
+        while True:
+            req = None
+            try:
+                create = Request.create(self, reader, writer,
+                                        writer.get_extra_info('peername'))
+                if count == 0:
+                    req = await create
+                else:
+                    # wait for the next request on a persistent connection
+                    req = await asyncio.wait_for(create,
+                                                 self.keep_alive_timeout)
+                    if req is None:  # pragma: no cover
+                        # the client closed the connection
+                        break
+            except asyncio.TimeoutError:  # pragma: no cover
+                break
+            except Exception as exc:  # pragma: no cover
+                print_exception(exc)
+            count += 1
+
+            res = await self.dispatch_request(req)
+            if res != Response.already_handled and req and \
+                    req.http_version == '1.1':
+                res.http_version = '1.1'
+            keep_alive = self._keep_alive(req, res, count)
+            if res != Response.already_handled:  # pragma: no branch
+                res.headers['Connection'] = \
+                    'keep-alive' if keep_alive else 'close'
+                await res.write(writer)
+            if self.debug and req:  # pragma: no cover
+                print('{method} {path} {status_code}'.format(
+                    method=req.method, path=req.path,
+                    status_code=res.status_code))
+            if not keep_alive:
+                break
         try:
             await writer.aclose()
         except OSError as exc:  # pragma: no cover
@@ -1344,10 +1739,28 @@ class Microdot:
                 pass
             else:
                 raise
-        if self.debug and req:  # pragma: no cover
-            print('{method} {path} {status_code}'.format(
-                method=req.method, path=req.path,
-                status_code=res.status_code))
+
+    def _keep_alive(self, req, res, count):
+        """Decide if the connection can be kept open for another request
+        after sending this response."""
+        if req is None or res == Response.already_handled or \
+                self.keep_alive_timeout <= 0 or \
+                count >= self.max_keep_alive_requests:
+            return False
+        connection = req.headers.get('Connection', '').lower()
+        if req.http_version == '1.1':
+            if 'close' in connection:
+                return False
+        elif 'keep-alive' not in connection:
+            return False
+        if req.content_length > Request.max_body_length:
+            # the request body may not have been consumed
+            return False
+        # the client can only find the end of the response body if its
+        # length is known or it is sent in chunks
+        res.complete()
+        return res.is_head or 'Content-Length' in res.headers or \
+            res.headers.get('Transfer-Encoding') == 'chunked'
 
     async def dispatch_request(self, req):
         after_request_handled = False
@@ -0,0 +1,128 @@
+import os
+import time
+from microdot.microdot import Response
+
+_DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+_MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+           'Oct', 'Nov', 'Dec']
+
+
+def http_date(timestamp):
+    """Format a timestamp as an HTTP date."""
+    t = time.gmtime(timestamp)
+    return '{}, {:02d} {} {:04d} {:02d}:{:02d}:{:02d} GMT'.format(
+        _DAYS[t[6]], t[2], _MONTHS[t[1] - 1], t[0], t[3], t[4], t[5])
+
+
+class StaticFiles:
+    """Serve static files from a directory.
+
+    :param root: The directory where the static files are stored.
+    :param max_age: The ``Cache-Control`` header's ``max-age`` value in
+                    seconds. If omitted, the value of the
+                    :attr:`Response.default_send_file_max_age` attribute is
+                    used.
+    :param cache_size: The total number of bytes of file contents that are
+                       kept in memory. Set to 0 to disable the cache.
+    :param max_cached_file_size: The largest file that is kept in memory.
+
+    When the client accepts gzip encoding and a precompressed copy of the
+    requested file exists with an added ``.gz`` extension, the compressed
+    copy is served. Responses include ``ETag`` and ``Last-Modified`` headers,
+    and conditional requests with ``If-None-Match`` or ``If-Modified-Since``
+    headers are answered with a 304 status code when the file has not
+    changed. ``Range`` requests are answered with partial responses.
+
+    Files are assumed not to change while the server is running, so the
+    file information and contents are cached without being checked again.
+
+    Example::
+
+        static_files = StaticFiles('static', max_age=86400)
+
+        @app.route('/static/<path:path>')
+        async def static(request, path):
+            if '..' in path:
+                return 'Not found', 404
+            return static_files.send(request, path)
+    """
+    def __init__(self, root, max_age=None, cache_size=16 * 1024,
+                 max_cached_file_size=8 * 1024):
+        self.root = root.rstrip('/')
+        self.max_age = max_age
+        self.cache_size = cache_size
+        self.max_cached_file_size = max_cached_file_size
+        self.files = {}
+        self.cache = {}
+        self.cache_used = 0
+
+    def send(self, request, path):
+        """Return a response for a static file request.
+
+        :param request: The request object.
+        :param path: The path of the file, relative to the root directory.
+
+        Security note: The path is assumed to be safe. Never pass a path
+        provided by the user without checking for directory traversal first.
+        """
+        gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+        info = self._file_info(path, gzip)
+        if info is None:
+            return Response('Not found', 404)
+        filename, compressed, size, etag, last_modified = info
+
+        headers = {'ETag': etag, 'Last-Modified': last_modified}
+        if compressed is not None:
+            headers['Vary'] = 'Accept-Encoding'
+        if_none_match = request.headers.get('If-None-Match')
+        if (if_none_match is not None and
+                (etag in if_none_match or if_none_match == '*')) or \
+                (if_none_match is None and request.headers.get(
+                    'If-Modified-Since') == last_modified):
+            res = Response(status_code=304, headers=headers)
+            res.headers['Content-Length'] = str(size)
+            return res
+
+        data = self.cache.get(filename)
+        if data is None and size <= self.max_cached_file_size and \
+                size <= self.cache_size:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            self._cache_add(filename, data)
+
+        res = Response.send_file(self.root + '/' + path, stream=data,
+                                 max_age=self.max_age, compressed=compressed,
+                                 file_extension='.gz' if compressed else '')
+        res.headers.update(headers)
+        res.headers['Content-Length'] = str(size)
+        return res.set_range(request, size)
+
+    def _file_info(self, path, gzip):
+        key = (path, gzip)
+        if key not in self.files:
+            filename = self.root + '/' + path
+            compressed = None
+            stat = None
+            try:
+                stat = os.stat(filename + '.gz')
+                compressed = gzip
+            except OSError:
+                pass
+            if not compressed:
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    return None
+            else:
+                filename += '.gz'
+            etag = '"{:x}-{:x}"'.format(stat[8], stat[6])
+            self.files[key] = (filename, compressed, stat[6], etag,
+                               http_date(stat[8]))
+        return self.files[key]
+
+    def _cache_add(self, filename, data):
+        while self.cache and self.cache_used + len(data) > self.cache_size:
+            evicted = next(iter(self.cache))
+            self.cache_used -= len(self.cache.pop(evicted))
+        self.cache[filename] = data
+        self.cache_used += len(data)
@@ -1,6 +1,15 @@
+import os
+import sys
+import time
 from utemplate import recompile
 
 _loader = None
+_auto_reload = True
+_reload_interval = 1
+_bytes_output = False
+
+# process-wide cache of loaded templates, as [render, checked, mtime] lists
+_cache = {}
 
 
 class Template:
@@ -11,7 +20,8 @@ class Template:
     """
     @classmethod
     def initialize(cls, template_dir='templates',
-                   loader_class=recompile.Loader):
+                   loader_class=recompile.Loader, auto_reload=True,
+                   reload_interval=1, bytes_output=False):
         """Initialize the templating subsystem.
 
         :param template_dir: the directory where templates are stored. This
@@ -22,16 +32,62 @@ class Template:
                              is the ``recompile.Loader`` class, which
                              automatically recompiles templates when they
                              change.
+        :param auto_reload: If ``True`` (development mode), templates are
+                            checked for changes, and reloaded if necessary,
+                            at most once every ``reload_interval`` seconds.
+                            If ``False`` (production mode), templates are
+                            loaded once and the file system is not accessed
+                            again. The default is ``True``.
+        :param reload_interval: The minimum time in seconds between checks
+                                for template changes in development mode.
+        :param bytes_output: If ``True``, templates are compiled to render
+                             functions that yield encoded chunks of about
+                             512 bytes instead of many small strings. Only
+                             loaders that compile templates support this
+                             option. The default is ``False``.
         """
-        global _loader
+        global _loader, _auto_reload, _reload_interval, _bytes_output
         _loader = loader_class(None, template_dir)
+        if bytes_output:
+            from utemplate.source import BytesCompiler
+            _loader.compiler_class = BytesCompiler
+            _loader.suffix = '_b'
+        _bytes_output = bytes_output
+        _auto_reload = auto_reload
+        _reload_interval = reload_interval
+        _cache.clear()
 
     def __init__(self, template):
         if _loader is None:  # pragma: no cover
             self.initialize()
         #: The name of the template
         self.name = template
-        self.template = _loader.load(template)
+        self.template = self._load(template)
+
+    @staticmethod
+    def _load(template):
+        entry = _cache.get(template)
+        if entry is not None and not _auto_reload:
+            return entry[0]
+
+        now = time.time()
+        if entry is not None and now - entry[1] < _reload_interval:
+            return entry[0]
+
+        mtime = None
+        if _auto_reload and hasattr(_loader, 'dir'):
+            mtime = os.stat(
+                _loader.pkg_path + _loader.dir + '/' + template)[8]
+            if entry is not None and entry[2] == mtime:
+                entry[1] = now
+                return entry[0]
+            if entry is not None:
+                # force the recompiled template module to be imported again
+                sys.modules.pop(_loader.p + template.replace('.', '_') +
+                                _loader.suffix, None)
+
+        _cache[template] = [_loader.load(template), now, mtime]
+        return _cache[template][0]
 
     def generate(self, *args, **kwargs):
         """Return a generator that renders the template in chunks, with the
@@ -40,8 +96,10 @@ class Template:
 
     def render(self, *args, **kwargs):
         """Render the template with the given arguments and return it as a
-        string."""
-        return ''.join(self.generate(*args, **kwargs))
+        string, or as bytes if templates are compiled with ``bytes_output``
+        enabled."""
+        return (b'' if _bytes_output else '').join(
+            self.generate(*args, **kwargs))
 
     def generate_async(self, *args, **kwargs):
         """Return an asynchronous generator that renders the template in
@@ -63,8 +121,9 @@ class Template:
 
     async def render_async(self, *args, **kwargs):
         """Render the template with the given arguments asynchronously and
-        return it as a string."""
-        response = ''
+        return it as a string, or as bytes if templates are compiled with
+        ``bytes_output`` enabled."""
+        response = b'' if _bytes_output else ''
         async for chunk in self.generate_async(*args, **kwargs):
             response += chunk
         return response
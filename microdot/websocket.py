@@ -1,3 +1,4 @@
+import asyncio
 import binascii
 import hashlib
 from microdot import Request, Response
@@ -35,9 +36,23 @@ class WebSocket:
     #:    WebSocket.max_message_length = 4 * 1024  # up to 4KB messages
     max_message_length = -1
 
+    #: The largest payload that is sent in a single frame. Longer messages
+    #: are sent as a sequence of fragments of at most this size.
+    max_frame_size = 4096
+
+    #: Frames with payloads up to this size are sent with the header in a
+    #: single write. Larger payloads are written separately from the header
+    #: to avoid copying them.
+    small_frame_size = 128
+
     def __init__(self, request):
         self.request = request
         self.closed = False
+        self.fragments = None
+        self.fragments_opcode = None
+        # frames of a message must not be interleaved with frames written by
+        # other tasks, such as PONG replies sent from receive()
+        self.write_lock = asyncio.Lock()
 
     async def handshake(self):
         response = self._handshake_response()
@@ -61,15 +76,53 @@ class WebSocket:
     async def send(self, data, opcode=None):
         """Send a message to the client.
 
-        :param data: the data to send, given as a string or bytes.
+        :param data: the data to send, given as a string or bytes. Messages
+                     longer than ``max_frame_size`` are sent in fragments.
         :param opcode: a custom frame opcode to use. If not given, the opcode
                        is ``TEXT`` or ``BINARY`` depending on the type of the
                        data.
         """
-        frame = self._encode_websocket_frame(
-            opcode or (self.TEXT if isinstance(data, str) else self.BINARY),
-            data)
-        await self.request.sock[1].awrite(frame)
+        opcode = opcode or (self.TEXT if isinstance(data, str)
+                            else self.BINARY)
+        if isinstance(data, str):
+            data = data.encode()
+        async with self.write_lock:
+            payload = memoryview(data)
+            length = len(payload)
+            start = 0
+            while True:
+                end = min(start + self.max_frame_size, length)
+                await self._write_frame(opcode, payload[start:end],
+                                        fin=end == length)
+                if end == length:
+                    break
+                opcode = self.CONT
+                start = end
+
+    async def send_fragments(self, chunks, opcode=BINARY):
+        """Send a message to the client as a sequence of fragments.
+
+        :param chunks: an iterable or asynchronous iterable with the data to
+                       send, given as strings or bytes. Each chunk is sent as
+                       a fragment, so the message does not need to be held in
+                       memory at once.
+        :param opcode: the opcode of the message, ``BINARY`` by default.
+        """
+        async with self.write_lock:
+            chunk = None
+            if hasattr(chunks, '__anext__'):
+                async for next_chunk in chunks:
+                    if chunk is not None:
+                        await self._write_frame(opcode, chunk, fin=False)
+                        opcode = self.CONT
+                    chunk = next_chunk
+            else:
+                for next_chunk in chunks:
+                    if chunk is not None:
+                        await self._write_frame(opcode, chunk, fin=False)
+                        opcode = self.CONT
+                    chunk = next_chunk
+            await self._write_frame(opcode, chunk or b'')
 
     async def close(self):
         """Close the websocket connection."""
@@ -103,8 +156,6 @@ class WebSocket:
     def _parse_frame_header(cls, header):
         fin = header[0] & 0x80
         opcode = header[0] & 0x0f
-        if fin == 0 or opcode == cls.CONT:  # pragma: no cover
-            raise WebSocketError('Continuation frames not supported')
         has_mask = header[1] & 0x80
         length = header[1] & 0x7f
         if length == 126:
@@ -127,43 +178,91 @@ class WebSocket:
         return None, payload
 
     @classmethod
-    def _encode_websocket_frame(cls, opcode, payload):
-        frame = bytearray()
-        frame.append(0x80 | opcode)
-        if opcode == cls.TEXT:
+    def _encode_frame_header(cls, opcode, length, fin=True):
+        header = bytearray()
+        header.append((0x80 if fin else 0) | opcode)
+        if length < 126:
+            header.append(length)
+        elif length < (1 << 16):
+            header.append(126)
+            header.extend(length.to_bytes(2, 'big'))
+        else:
+            header.append(127)
+            header.extend(length.to_bytes(8, 'big'))
+        return header
+
+    async def _write_frame(self, opcode, payload, fin=True):
+        if isinstance(payload, str):
             payload = payload.encode()
-        if len(payload) < 126:
-            frame.append(len(payload))
-        elif len(payload) < (1 << 16):
-            frame.append(126)
-            frame.extend(len(payload).to_bytes(2, 'big'))
+        header = self._encode_frame_header(opcode, len(payload), fin)
+        if len(payload) <= self.small_frame_size:
+            header.extend(payload)
+            await self.request.sock[1].awrite(header)
         else:
-            frame.append(127)
-            frame.extend(len(payload).to_bytes(8, 'big'))
-        frame.extend(payload)
-        return frame
+            await self.request.sock[1].awrite(header)
+            await self.request.sock[1].awrite(payload)
 
-    async def _read_frame(self):
-        header = await self.request.sock[0].read(2)
-        if len(header) != 2:  # pragma: no cover
+    async def _read_exactly(self, n):
+        try:
+            return await self.request.sock[0].readexactly(n)
+        except EOFError:
             raise WebSocketError('Websocket connection closed')
+
+    @staticmethod
+    def _unmask(payload, mask):
+        # XOR the whole payload with the repeated mask as one big integer,
+        # which is much faster than going byte by byte
+        length = len(payload)
+        if not length:
+            return payload
+        key = (mask * ((length >> 2) + 1))[:length]
+        return (int.from_bytes(payload, 'big') ^
+                int.from_bytes(key, 'big')).to_bytes(length, 'big')
+
+    async def _read_frame(self):
+        while True:
+            fin, opcode, payload = await self._read_frame_part()
+            if opcode & 0x08:
+                # control frames can arrive between fragments of a message
+                return opcode, payload
+            if opcode != self.CONT:
+                if self.fragments is not None:  # pragma: no cover
+                    raise WebSocketError('Expected continuation frame')
+                if fin:
+                    return opcode, payload
+                self.fragments = bytearray(payload)
+                self.fragments_opcode = opcode
+            else:
+                if self.fragments is None:  # pragma: no cover
+                    raise WebSocketError('Unexpected continuation frame')
+                self.fragments.extend(payload)
+                if fin:
+                    payload = bytes(self.fragments)
+                    self.fragments = None
+                    return self.fragments_opcode, payload
+
+    async def _read_frame_part(self):
+        header = await self._read_exactly(2)
         fin, opcode, has_mask, length = self._parse_frame_header(header)
         if length == -2:
-            length = await self.request.sock[0].read(2)
+            length = await self._read_exactly(2)
             length = int.from_bytes(length, 'big')
         elif length == -8:
-            length = await self.request.sock[0].read(8)
+            length = await self._read_exactly(8)
             length = int.from_bytes(length, 'big')
         max_allowed_length = Request.max_body_length \
             if self.max_message_length == -1 else self.max_message_length
+        if self.fragments is not None and opcode == self.CONT:
+            # the limit applies to the reassembled message
+            max_allowed_length -= len(self.fragments)
         if length > max_allowed_length:
             raise WebSocketError('Message too large')
         if has_mask:  # pragma: no cover
-            mask = await self.request.sock[0].read(4)
-        payload = await self.request.sock[0].read(length)
+            mask = await self._read_exactly(4)
+        payload = await self._read_exactly(length)
         if has_mask:  # pragma: no cover
-            payload = bytes(x ^ mask[i % 4] for i, x in enumerate(payload))
-        return opcode, payload
+            payload = self._unmask(payload, mask)
+        return fin, opcode, payload
 
 
 async def websocket_upgrade(request):
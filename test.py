@@ -1,11 +1,15 @@
 import asyncio
 import os
 import webserver
+from microdot.utemplate import Template
 
 
 class TestLogger:
     def __init__(self):
         self.root_dir = "log"
+        self.vfs_free = 123456
+        self.status_events = []
+        self.status_event = asyncio.Event()
 
     async def log(self):
         await asyncio.sleep(1)
@@ -30,8 +34,8 @@ class TestLogger:
             )
         )
 
-    def get_vfs_free(self):
-        return 123456
+    def get_status_event(self):
+        return {"status": "idle", "touch": 0}
 
     async def get_delays(self):
         await asyncio.sleep(0.5)
@@ -41,6 +45,9 @@ class TestLogger:
         print(delays)
 
 
+# Reload templates when they change
+Template.initialize(auto_reload=True, bytes_output=True)
+
 logger = TestLogger()
 
 app = webserver.create_app(logger)
@@ -1,5 +1,8 @@
 class Loader:
 
+    # Suffix added to compiled template module names
+    suffix = ""
+
     def __init__(self, pkg, dir):
         if dir == ".":
             dir = ""
@@ -10,5 +13,5 @@ class Loader:
         self.p = dir
 
     def load(self, name):
-        name = name.replace(".", "_")
+        name = name.replace(".", "_") + self.suffix
         return __import__(self.p + name, None, None, (name,)).render
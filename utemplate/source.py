@@ -75,7 +75,7 @@ class Compiler:
 
             with self.loader.input_open(tokens[0][1:-1]) as inc:
                 self.seq += 1
-                c = Compiler(inc, self.file_out, len(self.stack) + self._indent, self.seq)
+                c = self.__class__(inc, self.file_out, len(self.stack) + self._indent, self.seq, self.loader)
                 inc_id = self.seq
                 self.seq = c.compile()
             self.indent()
@@ -142,8 +142,78 @@ class Compiler:
         return self.seq
 
 
+class BytesCompiler(Compiler):
+    """Compiler for render functions that write pre-encoded bytes into a
+    buffer and yield the buffer in chunks of about CHUNK_SIZE bytes.
+
+    Adjacent literal text is merged, including across statements that
+    produce no output ("args" and "set").
+    """
+
+    CHUNK_SIZE = 512
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending = []
+
+    def indent(self, adjust=0):
+        if not self.flushed_header:
+            super().indent()
+            self.file_out.write("_b = bytearray()\n")
+        super().indent(adjust)
+
+    def literal(self, s):
+        if s:
+            self.pending.append(s)
+            self.in_literal = True
+
+    def close_literal(self):
+        self.in_literal = False
+
+    def flush_literal(self):
+        if self.pending:
+            self.indent()
+            self.file_out.write("_b.extend(%r)\n" % "".join(self.pending).encode())
+            self.pending = []
+
+    def yield_buffer(self, adjust=0):
+        self.indent(adjust)
+        self.file_out.write("yield _b\n")
+        self.indent(adjust)
+        self.file_out.write("_b = bytearray()\n")
+
+    def render_expr(self, e):
+        self.flush_literal()
+        self.indent()
+        self.file_out.write("_b.extend(str(" + e + ").encode())\n")
+
+    def parse_statement(self, stmt):
+        tokens = stmt.split(None, 1)
+        if tokens[0] not in ("args", "set"):
+            self.flush_literal()
+        if tokens[0] in ("endfor", "endwhile"):
+            # Yield buffer at end of loop body once it is large enough
+            self.indent()
+            self.file_out.write("if len(_b) >= %d:\n" % self.CHUNK_SIZE)
+            self.yield_buffer(1)
+        elif tokens[0] == "include":
+            self.yield_buffer()
+        super().parse_statement(stmt)
+
+    def compile(self):
+        seq = super().compile()
+        self.flush_literal()
+        self.indent()
+        self.file_out.write("if _b:\n")
+        self.indent(1)
+        self.file_out.write("yield _b\n")
+        return seq
+
+
 class Loader(compiled.Loader):
 
+    compiler_class = Compiler
+
     def __init__(self, pkg, dir):
         super().__init__(pkg, dir)
         self.dir = dir
@@ -169,7 +239,7 @@ class Loader(compiled.Loader):
         return open(path)
 
     def compiled_path(self, template):
-        return self.dir + "/" + template.replace(".", "_") + ".py"
+        return self.dir + "/" + template.replace(".", "_") + self.suffix + ".py"
 
     def load(self, name):
         try:
@@ -181,7 +251,7 @@ class Loader(compiled.Loader):
 
         f_in = self.input_open(name)
         f_out = open(compiled_path, "w")
-        c = Compiler(f_in, f_out, loader=self)
+        c = self.compiler_class(f_in, f_out, loader=self)
         c.compile()
         f_in.close()
         f_out.close()
@@ -1,22 +1,112 @@
 import asyncio
+import json
 
-from microdot import Microdot, Response, redirect, send_file
+from microdot import Microdot, Response, redirect
+from microdot.static import StaticFiles
 from microdot.utemplate import Template
 from microdot.websocket import with_websocket
 
 Response.default_content_type = "text/html"
 
+# Templates are loaded once, without checking for changes
+Template.initialize(auto_reload=False, bytes_output=True)
 
-def create_app(logger):
+# Interval (ms) between live strike batches
+LIVE_BATCH_INTERVAL = 250
+
+# Maximum number of messages queued for each websocket client
+MAX_CLIENT_MESSAGES = 8
+
+
+# Bounded message queue for a websocket client. The oldest message is dropped
+# if the client falls behind
+class MessageQueue:
+    def __init__(self, size=MAX_CLIENT_MESSAGES):
+        self.size = size
+        self.messages = []
+        self.event = asyncio.Event()
+        self.dropped = 0
+
+    def put(self, message):
+        if len(self.messages) >= self.size:
+            self.messages.pop(0)
+            self.dropped += 1
+
+        self.messages.append(message)
+        self.event.set()
+
+    async def get(self):
+        while not self.messages:
+            self.event.clear()
+            await self.event.wait()
+
+        return self.messages.pop(0)
+
+
+# Send queued messages to a websocket client
+async def send_messages(ws, queue):
+    while True:
+        await ws.send(await queue.get())
+
+
+def create_app(logger, metrics=False):
     app = Microdot()
 
+    if metrics:
+        # Request metrics in Prometheus format at /metrics, only imported
+        # when enabled to save memory
+        from microdot.metrics import Metrics
+
+        Metrics(app)
+
+    static_files = StaticFiles("static", max_age=86400)
+
+    status_clients = []
+    status_task = None
+
+    # Fan out logger status events to all status websocket clients
+    async def broadcast_status():
+        while True:
+            await logger.status_event.wait()
+            logger.status_event.clear()
+
+            while logger.status_events:
+                message = json.dumps(logger.status_events.pop(0))
+                for client in status_clients:
+                    client.put(message)
+
+    live_clients = []
+    live_task = None
+
+    # Fan out batches of live strikes to all strike stream clients, every
+    # LIVE_BATCH_INTERVAL ms or sooner if the logger's batch is full. Runs
+    # only while there are clients
+    async def broadcast_strikes():
+        nonlocal live_task
+        while live_clients:
+            try:
+                await asyncio.wait_for(
+                    logger.live_event.wait(), LIVE_BATCH_INTERVAL / 1000
+                )
+            except asyncio.TimeoutError:
+                pass
+            logger.live_event.clear()
+
+            batch = logger.take_live_batch()
+            if batch:
+                for client in live_clients:
+                    client.put(batch)
+
+        live_task = None
+
     @app.route("/")
     async def index(request):
         log_info = logger.get_log_info()
         dirs, logcounts = list(zip(*log_info))
 
-        return Template("index.tpl").render(
-            dirs=dirs, logcounts=logcounts, free=logger.get_vfs_free()
+        # stream the page in chunks, chunked encoding is used for HTTP/1.1
+        return Template("index.tpl").generate(
+            dirs=dirs, logcounts=logcounts, free=logger.vfs_free
         )
 
     @app.route("/static/<path:path>")
@@ -24,13 +114,13 @@ def create_app(logger):
         if ".." in path:
             # directory traversal is not allowed
             return "Not found", 404
-        return send_file("static/" + path, max_age=86400)
+        return static_files.send(request, path)
 
     @app.get("/delays")
     async def get_delays(request):
         try:
             delays = await asyncio.wait_for(logger.get_delays(), 1)
-            return Template("delays.tpl").render(delays=delays)
+            return Template("delays.tpl").generate(delays=delays)
         except asyncio.TimeoutError:
             return "Timeout waiting for delays from logger", 500
 
@@ -48,43 +138,167 @@ def create_app(logger):
     @app.get("/download")
     async def download(request):
         log_dir = request.args.get("log")
-        tarfile = logger.make_tar(log_dir)
+        if not log_dir or "/" in log_dir or ".." in log_dir:
+            return "Not found", 404
 
-        response = send_file(tarfile, content_type="application/x-tar")
-        response.headers["Content-Disposition"] = 'attachment; filename="log.tar"'
+        tar_size, mtime, entries = logger.make_tar(log_dir)
 
-        return response
+        response = Response(
+            logger.tar_data(entries),
+            200,
+            {
+                "Content-Type": "application/x-tar",
+                "Content-Length": str(tar_size),
+                "Content-Disposition": 'attachment; filename="log.tar"',
+                "ETag": '"{:x}-{:x}"'.format(mtime, tar_size),
+            },
+        )
+
+        # Allow interrupted downloads to be resumed
+        return response.set_range(
+            request, tar_size, lambda start: logger.tar_data(entries, start=start)
+        )
 
     @app.get("/log")
     async def get_log_catalog(request):
-        return logger.get_catalog(), 200, {"Content-Type": "text/plain"}
+        if request.args.get("format") == "json":
+            # Paged catalog entries
+            try:
+                offset = int(request.args.get("offset", 0))
+                limit = int(request.args.get("limit", -1))
+            except ValueError:
+                return "Bad request", 400
+
+            return Response(
+                logger.get_catalog_json(max(offset, 0), limit),
+                200,
+                {
+                    "Content-Type": "application/json",
+                    "X-Total-Count": str(logger.get_catalog_length()),
+                },
+            )
+
+        # Stop at the touches catalogued now, as the size must match
+        length = logger.get_catalog_length()
+        return Response(
+            logger.get_catalog(length),
+            200,
+            {
+                "Content-Type": "text/plain",
+                "Content-Length": str(logger.get_catalog_size(length)),
+            },
+        )
 
     @app.get("/log/<touch_num>")
     async def get_touch_data(request, touch_num):
-        return (
-            logger.get_touch_data(int(touch_num)),
-            200,
-            {"Content-Type": "text/plain"},
+        touch_num = int(touch_num)
+        try:
+            filename, size, mtime = logger.get_touch_info(touch_num)
+        except OSError:
+            return "", 200, {"Content-Type": "text/plain"}
+
+        if "row" in request.args or "since_ticks" in request.args:
+            # Slice of count rows (all if not given), from a row or time
+            try:
+                if "since_ticks" in request.args:
+                    first, nbells = logger.find_touch_record(
+                        touch_num, since_ticks=int(request.args["since_ticks"])
+                    )
+                else:
+                    first, nbells = logger.find_touch_record(
+                        touch_num, row=int(request.args["row"])
+                    )
+                count = int(request.args.get("count", -1))
+            except ValueError:
+                return "Bad request", 400
+            except OSError:
+                return "Not found", 404
+
+            return Response(
+                logger.get_touch_data(
+                    touch_num, first=first, count=count * nbells if count >= 0 else -1
+                ),
+                200,
+                {"Content-Type": "text/plain"},
+            )
+
+        headers = {
+            "Content-Type": "text/plain",
+            "ETag": '"{:x}-{:x}"'.format(mtime, size),
+        }
+        if "Range" not in request.headers:
+            return Response(logger.get_touch_data(touch_num), 200, headers)
+
+        # CSV size is only known after a pass over the touch file. The touch
+        # being logged grows meanwhile, so bodies stop at the records counted
+        csv_size, bin_size = logger.touch_csv_size(filename, size)
+        headers["Content-Length"] = str(csv_size)
+        response = Response(
+            logger.get_touch_data(touch_num, size=bin_size), 200, headers
+        )
+
+        return response.set_range(
+            request,
+            csv_size,
+            lambda start: logger.get_touch_data(touch_num, start=start, size=bin_size),
         )
 
+    @app.get("/log/<touch_num>/stats")
+    async def get_touch_stats(request, touch_num):
+        try:
+            stats = logger.get_touch_stats(int(touch_num))
+        except OSError:
+            return "Not found", 404
+
+        return stats, 200, {"Content-Type": "application/json"}
+
+    @app.get("/ingest")
+    async def get_ingest_stats(request):
+        return logger.get_ingest_stats()
+
     @app.get("/status")
     @with_websocket
-    async def status(response, ws):
-        log_status = logger.get_status()
-        await ws.send(log_status)
+    async def status(request, ws):
+        nonlocal status_task
+        if status_task is None:
+            # Start broadcaster, discarding events from before any client
+            logger.status_events.clear()
+            status_task = asyncio.create_task(broadcast_status())
 
-        # Poll logger status
-        while True:
-            new_log_status = logger.get_status()
-            if log_status != new_log_status:
-                log_status = new_log_status
+        queue = MessageQueue()
+        queue.put(json.dumps(logger.get_status_event()))
+        status_clients.append(queue)
 
-                await ws.send(log_status)
+        sender = asyncio.create_task(send_messages(ws, queue))
+        try:
+            # Receive (and discard) messages to handle keep-alive pings
+            while True:
+                await ws.receive()
+        finally:
+            status_clients.remove(queue)
+            sender.cancel()
 
-            # Do (dummy) receive to handle keep-alive pings
-            try:
-                await asyncio.wait_for(ws.receive(), 1)
-            except asyncio.TimeoutError:
-                pass
+    # Live strike stream. Each binary message is a batch of strikes, a
+    # (touch number, strike count) header followed by (bell, ticks) records
+    # in the touch file format
+    @app.get("/strikes")
+    @with_websocket
+    async def strikes(request, ws):
+        nonlocal live_task
+        queue = MessageQueue()
+        live_clients.append(queue)
+        logger.live_clients = len(live_clients)
+        if live_task is None:
+            live_task = asyncio.create_task(broadcast_strikes())
+
+        sender = asyncio.create_task(send_messages(ws, queue))
+        try:
+            # Receive (and discard) messages to handle keep-alive pings
+            while True:
+                await ws.receive()
+        finally:
+            live_clients.remove(queue)
+            logger.live_clients = len(live_clients)
+            sender.cancel()
 
     return app